@@ -0,0 +1,426 @@
+"""
+This file contains micro-benchmarks for the Chapter 13 browser.
+Run it with the name of a benchmark, for example:
+
+    python3 benchmark13.py tls
+"""
+
+import gc
+import http.server
+import lab4
+import os
+import random
+import ssl
+import subprocess
+import tempfile
+import threading
+import time
+import tracemalloc
+import lab13
+
+def average_ms(times):
+    return sum(times) / len(times) * 1000
+
+def make_test_certificate(directory):
+    cert = os.path.join(directory, "cert.pem")
+    key = os.path.join(directory, "key.pem")
+    subprocess.run([
+        "openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes",
+        "-keyout", key, "-out", cert, "-days", "1",
+        "-subj", "/CN=localhost",
+        "-addext", "subjectAltName=DNS:localhost",
+    ], check=True, capture_output=True)
+    return cert, key
+
+class QuietHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        body = b"ok"
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+def start_tls_server(cert, key):
+    server = http.server.ThreadingHTTPServer(("localhost", 0), QuietHandler)
+    ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    ctx.load_cert_chain(cert, key)
+    server.socket = ctx.wrap_socket(server.socket, server_side=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def benchmark_tls(args):
+    with tempfile.TemporaryDirectory() as directory:
+        cert, key = make_test_certificate(directory)
+        server = start_tls_server(cert, key)
+        port = server.server_address[1]
+        lab13.TLS_CA_FILE = cert
+
+        for use_caches in [False, True]:
+            lab13.USE_CONNECTION_CACHES = use_caches
+            lab13.TLS_CONTEXT = None
+            lab13.TLS_SESSIONS.clear()
+            lab13.DNS_CACHE = lab13.DNSCache(lab13.DNS_CACHE_TTL_SEC)
+
+            times = []
+            resumed = 0
+            for i in range(args.rounds):
+                start = time.perf_counter()
+                conn = lab13.HTTPConnection("https", "localhost", port)
+                times.append(time.perf_counter() - start)
+                resumed += conn.socket.session_reused
+
+                # Reading a response also receives the TLS 1.3 session
+                # tickets that make the next handshake resumable.
+                response = conn.send(
+                    b"GET / HTTP/1.1\r\nHost: localhost\r\n\r\n")
+                while response.readline() not in [b"\r\n", b""]: pass
+                response.read(2)
+                conn.close()
+
+            print("connect+handshake {}: {:>.2f}ms on average, {}/{} resumed"
+                .format("with caches" if use_caches else "without caches",
+                    average_ms(times), resumed, args.rounds))
+        server.shutdown()
+
+HTML_BLOCK = (
+    "<div class=article id=item{}>\n"
+    "<h2>Heading number {}</h2>\n"
+    "<p style='color: gray'>" + "Lorem ipsum dolor sit amet, " * 12 +
+    "<b>bold</b> and <i>italic</i> text.</p>\n"
+    "<a href=/page{}>Read more</a><br>\n"
+    "</div>\n"
+)
+
+def make_html_document(size):
+    blocks = []
+    length = 0
+    i = 0
+    while length < size:
+        block = HTML_BLOCK.format(i, i, i)
+        blocks.append(block)
+        length += len(block)
+        i += 1
+    return "<!doctype html><html><head><title>Benchmark</title></head>" + \
+        "<body>" + "".join(blocks) + "</body></html>"
+
+def tree_signature(tree):
+    nodes = 0
+    signature = 0
+    stack = [tree]
+    while stack:
+        node = stack.pop()
+        nodes += 1
+        if isinstance(node, (lab4.Text, lab13.Text)):
+            signature = hash((signature, node.text))
+        else:
+            signature = hash((signature, node.tag,
+                tuple(sorted(node.attributes.items())),
+                len(node.children)))
+            stack.extend(reversed(node.children))
+    return nodes, signature
+
+def time_parse(parser_class, body):
+    gc.collect()
+    start = time.perf_counter()
+    tree = parser_class(body).parse()
+    elapsed = time.perf_counter() - start
+    return elapsed, tree_signature(tree)
+
+def benchmark_html(args):
+    for megabytes in args.sizes:
+        body = make_html_document(megabytes * 1024 * 1024)
+        old_time, old_tree = time_parse(lab4.HTMLParser, body)
+        new_time, new_tree = time_parse(lab13.HTMLParser, body)
+        assert old_tree == new_tree, "Parsers built different trees"
+        print("{}MB, {} nodes: lab4 {:>.2f}s, lab13 {:>.2f}s ({:>.1f}x)"
+            .format(megabytes, new_tree[0], old_time, new_time,
+                old_time / new_time))
+
+def tree_bytes(parser_class, body):
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    tree = parser_class(body).parse()
+    gc.collect()
+    size = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return size, tree_signature(tree)
+
+def benchmark_memory(args):
+    for megabytes in args.sizes:
+        body = make_html_document(megabytes * 1024 * 1024)
+        old_size, old_tree = tree_bytes(lab4.HTMLParser, body)
+        new_size, new_tree = tree_bytes(lab13.HTMLParser, body)
+        assert old_tree == new_tree, "Parsers built different trees"
+        nodes = new_tree[0]
+        print("{}MB, {} nodes: lab4 {:>.0f} bytes/node, lab13 {:>.0f} bytes/node"
+            .format(megabytes, nodes, old_size / nodes, new_size / nodes))
+
+RAF_PAGE = "<div>Animation</div><div>count: 0</div><div>XHR</div>"
+
+# Like eventloop12.js, but without the busy loop.
+RAF_SCRIPT = """
+var count = 0;
+function callback() {
+    var output = document.querySelectorAll("div")[1];
+    output.innerHTML = "<b>count:</b> " + (count++);
+    requestAnimationFrame(callback);
+}
+requestAnimationFrame(callback);
+"""
+
+class BenchmarkTab:
+    def __init__(self, body):
+        self.url = "http://benchmark.test/"
+        self.nodes = lab13.HTMLParser(body).parse()
+        self.browser = self
+        self.js = lab13.JSContext(self)
+
+    def set_needs_animation_frame(self, tab):
+        pass
+
+    def set_needs_render(self):
+        pass
+
+def wrapper_innerHTML_set(self, handle, s):
+    doc = lab13.HTMLParser(
+        "<html><body>" + s + "</body></html>").parse()
+    new_nodes = doc.children[0].children
+    elt = self.handle_to_node[handle]
+    elt.children = new_nodes
+    for child in elt.children:
+        child.parent = elt
+    self.tab.set_needs_render()
+
+def time_raf_loop(innerHTML_set, frames):
+    times = []
+    def timed_innerHTML_set(self, handle, s):
+        start = time.perf_counter()
+        innerHTML_set(self, handle, s)
+        times.append(time.perf_counter() - start)
+    original = lab13.JSContext.innerHTML_set
+    lab13.JSContext.innerHTML_set = timed_innerHTML_set
+    try:
+        tab = BenchmarkTab(RAF_PAGE)
+        tab.js.interp.evaljs(RAF_SCRIPT)
+        start = time.perf_counter()
+        for i in range(frames):
+            tab.js.interp.evaljs("__runRAFHandlers()")
+        frame_time = (time.perf_counter() - start) / frames
+    finally:
+        lab13.JSContext.innerHTML_set = original
+    return frame_time * 1000, average_ms(times)
+
+def benchmark_raf(args):
+    frames = args.rounds * 100
+    for name, innerHTML_set in [
+        ("html/body wrapper", wrapper_innerHTML_set),
+        ("fragment parser", lab13.JSContext.innerHTML_set)]:
+        frame_ms, set_ms = time_raf_loop(innerHTML_set, frames)
+        print("{}: {:>.3f}ms per frame, {:>.3f}ms per innerHTML set"
+            .format(name, frame_ms, set_ms))
+
+def make_style_sheet(rule_count, tags):
+    rules = []
+    for i in range(rule_count):
+        selector = tags[i % len(tags)]
+        if i % 3 == 0:
+            selector = tags[(i * 7) % len(tags)] + " " + selector
+        rules.append("{} {{ color: #{:06x}; margin-left: {}px; }}".format(
+            selector, i, i % 20))
+    return "\n".join(rules)
+
+def make_styled_document(node_count, tags):
+    pieces = []
+    nodes = 0
+    while nodes < node_count:
+        outer, inner = random.choice(tags), random.choice(tags)
+        pieces.append("<{}><{}>text</{}></{}>".format(
+            outer, inner, inner, outer))
+        nodes += 3
+    return "".join(pieces)
+
+def time_style(nodes, rules):
+    start = time.perf_counter()
+    lab13.style(nodes, sorted(rules, key=lab13.cascade_priority), None)
+    elapsed = time.perf_counter() - start
+    styles = [node.style for node in lab13.tree_to_list(nodes, [])]
+    return elapsed, styles
+
+def benchmark_style(args):
+    random.seed(0)
+    tags = ["div", "p", "span", "li", "a", "b", "i", "em"] + \
+        ["x-tag{}".format(i) for i in range(200)]
+    rules = lab13.CSSParser(make_style_sheet(args.rules, tags)).parse()
+    nodes = lab13.HTMLParser(
+        make_styled_document(args.nodes, tags)).parse()
+    count = len(lab13.tree_to_list(nodes, []))
+    lab13.USE_RULE_INDEX = False
+    old_time, old_styles = time_style(nodes, rules)
+    lab13.USE_RULE_INDEX = True
+    new_time, new_styles = time_style(nodes, rules)
+    assert old_styles == new_styles, "Computed styles differ"
+    print("{} rules x {} nodes: every rule {:>.2f}s, rule index {:>.2f}s ({:>.0f}x)"
+        .format(len(rules), count, old_time, new_time,
+            old_time / new_time))
+
+def benchmark_ancestors(args):
+    depth = 30
+    block = "<div>" * depth + "<span>text</span>" + "</div>" * depth
+    body = "<section>" + block * (args.nodes // (depth + 2)) + "</section>"
+    nodes = lab13.HTMLParser(body).parse()
+    count = len(lab13.tree_to_list(nodes, []))
+    sheet = "\n".join(["x-tag{} div {{ color: red; }}".format(i)
+        for i in range(args.rules // 5)] + ["section span { color: blue; }"])
+    rules = lab13.CSSParser(sheet).parse()
+    lab13.USE_ANCESTOR_FILTER = False
+    old_time, old_styles = time_style(nodes, rules)
+    lab13.USE_ANCESTOR_FILTER = True
+    lab13.SELECTOR_STATS = lab13.SelectorStats()
+    new_time, new_styles = time_style(nodes, rules)
+    assert old_styles == new_styles, "Computed styles differ"
+    print("{} descendant rules x {} nodes: ancestor walks {:>.2f}s, "
+        "ancestor filter {:>.2f}s ({:>.0f}x)".format(len(rules), count,
+            old_time, new_time, old_time / new_time))
+    print(lab13.SELECTOR_STATS.text())
+
+def style_bytes(nodes, rules):
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    elapsed, styles = time_style(nodes, rules)
+    gc.collect()
+    size = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return elapsed, size, styles
+
+def benchmark_sharing(args):
+    items = "".join(["<li>Item {}</li>".format(i)
+        for i in range(args.nodes // 2)])
+    nodes = lab13.HTMLParser("<ul>" + items + "</ul>").parse()
+    count = len(lab13.tree_to_list(nodes, []))
+    rules = lab13.CSSParser(
+        "li { color: gray; margin-left: 4px; } ul li { font-size: 90%; }"
+    ).parse()
+    lab13.USE_STYLE_SHARING = False
+    old_time, old_size, old_styles = style_bytes(nodes, rules)
+    for node in lab13.tree_to_list(nodes, []):
+        del node.style
+    lab13.USE_STYLE_SHARING = True
+    new_time, new_size, new_styles = style_bytes(nodes, rules)
+    assert old_styles == new_styles, "Computed styles differ"
+    print("{} nodes: fresh styles {:>.3f}s, {:>.0f} bytes/node; "
+        "shared styles {:>.3f}s, {:>.0f} bytes/node".format(count,
+            old_time, old_size / count, new_time, new_size / count))
+
+def time_restyle(nodes, sheet, target, frames):
+    start = time.perf_counter()
+    for i in range(frames):
+        target.attributes["style"] = "margin-left:{}px".format(i)
+        if lab13.USE_INCREMENTAL_STYLE:
+            lab13.mark_style_dirty(target)
+            lab13.restyle_dirty(nodes, sheet, None)
+        else:
+            lab13.style(nodes, sheet, None)
+    elapsed = (time.perf_counter() - start) / frames
+    styles = [node.style for node in lab13.tree_to_list(nodes, [])]
+    return elapsed, styles
+
+def benchmark_restyle(args):
+    tags = ["div", "p", "span", "li", "a", "b", "i", "em"]
+    random.seed(0)
+    nodes = lab13.HTMLParser(
+        make_styled_document(args.nodes, tags)).parse()
+    count = len(lab13.tree_to_list(nodes, []))
+    rules = lab13.CSSParser(make_style_sheet(100, tags)).parse()
+    sheet = lab13.CompiledStyleSheet(rules, 0)
+    lab13.style(nodes, sheet, None)
+    target = nodes.children[0].children[len(nodes.children[0].children) // 2]
+    lab13.USE_INCREMENTAL_STYLE = False
+    old_time, old_styles = time_restyle(nodes, sheet, target, args.rounds)
+    lab13.USE_INCREMENTAL_STYLE = True
+    new_time, new_styles = time_restyle(nodes, sheet, target, args.rounds)
+    assert old_styles == new_styles, "Computed styles differ"
+    print("{} nodes, one style change per frame: full restyle {:>.2f}ms, "
+        "dirty subtree {:>.3f}ms ({:>.0f}x)".format(count,
+            old_time * 1000, new_time * 1000, old_time / new_time))
+
+CSS_DECLARATIONS = [
+    "color: #336699",
+    "background-color: lightblue",
+    "margin-left: 12px",
+    "font-family: 'Helvetica Neue', Arial, sans-serif",
+    "transition: opacity 2s,transform 1s",
+    "border-radius: 4px",
+    "transform: translate(10px,20px)",
+    "font-size: 120%",
+]
+
+def make_large_style_sheet(size):
+    tags = ["div", "p", "section", "article", "nav", "li", "a", "span"]
+    rules = []
+    length = 0
+    while length < size:
+        selector = " ".join(random.sample(tags, random.randint(1, 3)))
+        body = ";\n  ".join(random.sample(CSS_DECLARATIONS,
+            random.randint(2, 6)))
+        rule = "{} {{\n  {};\n}}\n\n".format(selector, body)
+        rules.append(rule)
+        length += len(rule)
+    return "".join(rules)
+
+def time_css_parse(body):
+    gc.collect()
+    start = time.perf_counter()
+    rules = lab13.CSSParser(body).parse()
+    elapsed = time.perf_counter() - start
+    return elapsed, [(repr(selector), body) for selector, body in rules]
+
+def benchmark_css(args):
+    random.seed(0)
+    for megabytes in args.sizes:
+        body = make_large_style_sheet(megabytes * 1024 * 1024)
+        lab13.USE_FAST_CSS_PARSER = False
+        old_time, old_rules = time_css_parse(body)
+        lab13.USE_FAST_CSS_PARSER = True
+        new_time, new_rules = time_css_parse(body)
+        assert old_rules == new_rules, "Parsers produced different rules"
+        print("{}MB, {} rules: character scanner {:>.1f}MB/s, "
+            "fast path {:>.1f}MB/s ({:>.1f}x)".format(megabytes,
+                len(new_rules), megabytes / old_time, megabytes / new_time,
+                old_time / new_time))
+
+BENCHMARKS = {
+    "ancestors": benchmark_ancestors,
+    "css": benchmark_css,
+    "html": benchmark_html,
+    "memory": benchmark_memory,
+    "raf": benchmark_raf,
+    "restyle": benchmark_restyle,
+    "sharing": benchmark_sharing,
+    "style": benchmark_style,
+    "tls": benchmark_tls,
+}
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Chapter 13 benchmarks')
+    parser.add_argument("benchmark", choices=sorted(BENCHMARKS),
+        help="Benchmark to run")
+    parser.add_argument("--rounds", type=int, default=50,
+        help="How many times to repeat the measured operation")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1, 10, 50],
+        help="Document sizes in megabytes for the html, memory and css benchmarks")
+    parser.add_argument("--rules", type=int, default=5000,
+        help="Number of CSS rules for the style and ancestors benchmarks")
+    parser.add_argument("--nodes", type=int, default=20000,
+        help="Number of DOM nodes for the style benchmarks")
+    args = parser.parse_args()
+
+    BENCHMARKS[args.benchmark](args)
@@ -4,34 +4,1188 @@ up to and including Chapter 13 (Animations and Compositing),
 without exercises.
 """
 
+import asyncio
+import codecs
+import collections
+import collections.abc
+import concurrent.futures
 import ctypes
+import functools
+import datetime
 import dukpy
+import email.utils
+import hashlib
+import heapq
 import io
+import itertools
+import json
 import math
+import os
+import re
 import sdl2
+import sys
 import skia
 import socket
 import ssl
 import threading
 import time
+import types
 import urllib.parse
+import zlib
+import lab4
+import lab6
 from lab4 import print_tree
-from lab4 import Element
-from lab4 import Text
-from lab4 import HTMLParser
+from lab5 import BLOCK_ELEMENTS
 from lab6 import cascade_priority
-from lab6 import layout_mode
 from lab6 import resolve_url
 from lab6 import tree_to_list
 from lab6 import INHERITED_PROPERTIES
 from lab6 import compute_style
-from lab6 import TagSelector, DescendantSelector
 from lab9 import EVENT_DISPATCH_CODE
-from lab10 import COOKIE_JAR, request, url_origin
+from lab10 import COOKIE_JAR, url_origin
 from lab11 import draw_line, draw_text, get_font, linespace, \
-    parse_blend_mode, parse_color, request, CHROME_PX, SCROLL_STEP
+    parse_blend_mode, parse_color, CHROME_PX, SCROLL_STEP
 import OpenGL.GL as GL
 
+MAX_IDLE_CONNECTIONS_PER_HOST = 6
+IDLE_CONNECTION_TIMEOUT_SEC = 30
+DNS_CACHE_TTL_SEC = 60
+USE_CONNECTION_CACHES = True
+TLS_CA_FILE = None
+
+def getaddrinfo(host, port):
+    infos = socket.getaddrinfo(
+        host, port, socket.AF_INET, socket.SOCK_STREAM)
+    return infos[0][4]
+
+class DNSCache:
+    def __init__(self, ttl, resolver=getaddrinfo):
+        self.ttl = ttl
+        self.resolver = resolver
+        self.lock = threading.Lock()
+        self.entries = {}
+
+    def resolve(self, host, port):
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get((host, port))
+        if entry and now < entry[1]:
+            return entry[0]
+
+        try:
+            address = self.resolver(host, port)
+        except socket.gaierror:
+            # Let connect() report the failure, or resolve the name
+            # some other way; don't remember it, so the next
+            # connection tries again.
+            return (host, port)
+
+        with self.lock:
+            self.entries[(host, port)] = (address, now + self.ttl)
+        return address
+
+DNS_CACHE = DNSCache(DNS_CACHE_TTL_SEC)
+
+TLS_CONTEXT = None
+TLS_SESSIONS = {}
+
+def make_tls_context():
+    ctx = ssl.create_default_context()
+    if TLS_CA_FILE:
+        ctx.load_verify_locations(TLS_CA_FILE)
+    return ctx
+
+class TLSSessionContext:
+    # asyncio can't pass a session to wrap_bio, so this wraps the shared
+    # context and adds the saved session to the connection.
+    def __init__(self, ctx, session):
+        self.ctx = ctx
+        self.session = session
+
+    def __getattr__(self, name):
+        return getattr(self.ctx, name)
+
+    def wrap_bio(self, incoming, outgoing, server_side=False,
+        server_hostname=None):
+        return self.ctx.wrap_bio(incoming, outgoing,
+            server_side=server_side, server_hostname=server_hostname,
+            session=self.session)
+
+def tls_context():
+    global TLS_CONTEXT
+    if not USE_CONNECTION_CACHES:
+        return make_tls_context()
+    if not TLS_CONTEXT:
+        TLS_CONTEXT = make_tls_context()
+    return TLS_CONTEXT
+
+TIMING_PHASES = [
+    "queued", "dns", "connect", "tls", "sent", "first_byte", "last_byte"]
+
+class RequestTiming:
+    def __init__(self, method, url):
+        self.method = method
+        self.url = url
+        self.start = time.time()
+        self.marks = {}
+
+    def mark(self, phase):
+        self.marks[phase] = time.time()
+
+    def durations(self):
+        durations = {}
+        previous = self.start
+        for phase in TIMING_PHASES:
+            if phase not in self.marks: continue
+            durations[phase] = self.marks[phase] - previous
+            previous = self.marks[phase]
+        return durations
+
+    def total(self):
+        if not self.marks: return 0
+        return max(self.marks.values()) - self.start
+
+    def har_timings(self):
+        durations = self.durations()
+        def ms(phase, missing):
+            if phase not in durations: return missing
+            return round(durations[phase] * 1000, 3)
+        timings = {
+            "blocked": ms("queued", -1),
+            "dns": ms("dns", -1),
+            "connect": ms("connect", -1),
+            "ssl": ms("tls", -1),
+            "send": ms("sent", 0),
+            "wait": ms("first_byte", 0),
+            "receive": ms("last_byte", 0),
+        }
+        # HAR counts the TLS handshake as part of the connection time.
+        if timings["ssl"] >= 0:
+            timings["connect"] = round(timings["connect"] + timings["ssl"], 3)
+        return timings
+
+class HTTPConnection:
+    def __init__(self, scheme, host, port, timing=None):
+        self.key = (scheme, host, port)
+        self.socket = socket.socket(
+            family=socket.AF_INET,
+            type=socket.SOCK_STREAM,
+            proto=socket.IPPROTO_TCP,
+        )
+        if USE_CONNECTION_CACHES:
+            address = DNS_CACHE.resolve(host, port)
+            if timing: timing.mark("dns")
+            self.socket.connect(address)
+        else:
+            self.socket.connect((host, port))
+        if timing: timing.mark("connect")
+
+        if scheme == "https":
+            ctx = tls_context()
+            session = None
+            if USE_CONNECTION_CACHES:
+                session = TLS_SESSIONS.get((host, port))
+            if session:
+                self.socket = ctx.wrap_socket(self.socket,
+                    server_hostname=host, session=session)
+            else:
+                self.socket = ctx.wrap_socket(self.socket,
+                    server_hostname=host)
+            if timing: timing.mark("tls")
+
+        self.file = None
+        self.last_used = time.time()
+        self.reused = False
+
+    def save_tls_session(self):
+        scheme, host, port = self.key
+        session = getattr(self.socket, "session", None)
+        if scheme == "https" and session and USE_CONNECTION_CACHES:
+            TLS_SESSIONS[(host, port)] = session
+
+    def send(self, text):
+        self.socket.sendall(text)
+        if not self.file:
+            self.file = self.socket.makefile("b")
+        return self.file
+
+    def close(self):
+        self.save_tls_session()
+        if self.file:
+            self.file.close()
+        self.socket.close()
+
+class ConnectionPool:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.idle = {}
+
+    def get(self, scheme, host, port, timing=None):
+        key = (scheme, host, port)
+        conn = None
+        expired = []
+        self.lock.acquire(blocking=True)
+        now = time.time()
+        for idle_key, idle in self.idle.items():
+            for idle_conn in idle:
+                if now - idle_conn.last_used > IDLE_CONNECTION_TIMEOUT_SEC:
+                    expired.append(idle_conn)
+            self.idle[idle_key] = [idle_conn for idle_conn in idle
+                if idle_conn not in expired]
+        if self.idle.get(key):
+            conn = self.idle[key].pop()
+        self.lock.release()
+
+        for idle_conn in expired:
+            idle_conn.close()
+        if conn:
+            conn.reused = True
+            return conn
+        return HTTPConnection(scheme, host, port, timing)
+
+    def put(self, conn):
+        conn.last_used = time.time()
+        self.lock.acquire(blocking=True)
+        idle = self.idle.setdefault(conn.key, [])
+        pooled = len(idle) < MAX_IDLE_CONNECTIONS_PER_HOST
+        if pooled:
+            idle.append(conn)
+        self.lock.release()
+        if not pooled:
+            conn.close()
+
+    def idle_count(self, scheme, host, port):
+        self.lock.acquire(blocking=True)
+        count = len(self.idle.get((scheme, host, port), []))
+        self.lock.release()
+        return count
+
+CONNECTION_POOL = ConnectionPool()
+
+
+READ_CHUNK_SIZE = 16 * 1024
+
+class ResponseBody:
+    def __init__(self, file, status, headers):
+        self.file = file
+        self.status = status
+        self.headers = headers
+        self.framed = False
+
+    def read_exactly(self, length):
+        while length > 0:
+            data = self.file.read1(min(length, READ_CHUNK_SIZE))
+            if not data: return False
+            length -= len(data)
+            yield data
+        return True
+
+    def __iter__(self):
+        if self.status.startswith("1") or self.status in ["204", "304"]:
+            self.framed = True
+        elif self.headers.get("transfer-encoding", "").lower() == "chunked":
+            while True:
+                size_line = self.file.readline()
+                size = int(size_line.split(b";", 1)[0].strip(), 16)
+                if size == 0: break
+                if not (yield from self.read_exactly(size)):
+                    raise EOFError("Response body ended early")
+                self.file.readline()
+            while True:
+                line = self.file.readline()
+                if line in [b"\r\n", b"\n", b""]: break
+            self.framed = True
+        elif "content-length" in self.headers:
+            length = int(self.headers["content-length"])
+            if not (yield from self.read_exactly(length)):
+                raise EOFError("Response body ended early")
+            self.framed = True
+        else:
+            while True:
+                data = self.file.read1(READ_CHUNK_SIZE)
+                if not data: break
+                yield data
+
+def keep_alive(version, headers):
+    connection = headers.get("connection", "").lower()
+    if version == "HTTP/1.1":
+        return connection != "close"
+    else:
+        return connection == "keep-alive"
+
+def response_charset(headers):
+    for param in headers.get("content-type", "").split(";")[1:]:
+        if "=" not in param: continue
+        name, value = param.split("=", 1)
+        if name.strip().lower() == "charset":
+            return value.strip().strip("\"'").lower()
+    return "utf8"
+
+def deflate_decompressor(head):
+    # Some servers send deflate data without a zlib header.
+    if len(head) >= 2 and head[0] & 0x0f == 8 and \
+        (head[0] << 8 | head[1]) % 31 == 0:
+        return zlib.decompressobj()
+    return zlib.decompressobj(-zlib.MAX_WBITS)
+
+class Response:
+    def __init__(self, url, status, headers, body=None, text=None,
+        cache_key=None, timing=None):
+        self.url = url
+        self.status = status
+        self.headers = headers
+        self.body = body
+        self.text = text
+        self.cache_key = cache_key
+        self.encoded_size = 0
+        self.decoded_size = 0
+        self.timing = timing or RequestTiming("GET", url)
+
+    def decompressed(self):
+        encoding = self.headers.get("content-encoding", "").strip().lower()
+        if encoding in ["gzip", "x-gzip"]:
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        else:
+            decompressor = None
+        head = b""
+        for data in self.body:
+            self.encoded_size += len(data)
+            if encoding == "deflate" and not decompressor:
+                head += data
+                if len(head) < 2: continue
+                decompressor = deflate_decompressor(head)
+                data = head
+            if decompressor:
+                data = decompressor.decompress(data)
+            self.decoded_size += len(data)
+            yield data
+        if head and not decompressor:
+            decompressor = deflate_decompressor(head)
+            data = decompressor.decompress(head)
+            self.decoded_size += len(data)
+            yield data
+        if decompressor:
+            data = decompressor.flush()
+            self.decoded_size += len(data)
+            yield data
+
+    def decoder(self):
+        try:
+            decoder = codecs.getincrementaldecoder(
+                response_charset(self.headers))
+        except LookupError:
+            decoder = codecs.getincrementaldecoder("utf8")
+        return decoder(errors="replace")
+
+    def chunks(self):
+        if self.text is not None:
+            self.decoded_size = len(self.text.encode("utf8"))
+            if self.text: yield self.text
+            return
+        decoder = self.decoder()
+        pieces = None
+        if self.cache_key:
+            if CacheEntry(self.headers, None, 0).is_cacheable():
+                pieces = []
+            else:
+                HTTP_CACHE.evict(self.cache_key)
+        for data in self.decompressed():
+            text = decoder.decode(data)
+            if not text: continue
+            if pieces is not None: pieces.append(text)
+            yield text
+        text = decoder.decode(b"", final=True)
+        if text:
+            if pieces is not None: pieces.append(text)
+            yield text
+        if pieces is not None:
+            HTTP_CACHE.store(self.cache_key, self.headers, "".join(pieces))
+
+    def __iter__(self):
+        return self.chunks()
+
+    def read(self):
+        return "".join(self.chunks())
+
+    def size_text(self):
+        return "{}: {} bytes transferred, {} bytes decoded".format(
+            self.url, self.encoded_size, self.decoded_size)
+
+    def har_entry(self):
+        return {
+            "startedDateTime": har_date(self.timing.start),
+            "time": round(self.timing.total() * 1000, 3),
+            "request": {
+                "method": self.timing.method,
+                "url": self.url,
+            },
+            "response": {
+                "status": int(self.status),
+                "headers": [{"name": name, "value": value}
+                    for name, value in self.headers.items()],
+                "content": {
+                    "size": self.decoded_size,
+                    "mimeType": self.headers.get("content-type", ""),
+                },
+                "bodySize": self.encoded_size,
+            },
+            "timings": self.timing.har_timings(),
+        }
+
+def har_date(timestamp):
+    return datetime.datetime.fromtimestamp(
+        timestamp, datetime.timezone.utc).isoformat()
+
+def parse_cache_control(headers):
+    directives = {}
+    for directive in headers.get("cache-control", "").split(","):
+        directive = directive.strip().lower()
+        if not directive: continue
+        if "=" in directive:
+            name, value = directive.split("=", 1)
+            directives[name.strip()] = value.strip().strip('"')
+        else:
+            directives[directive] = ""
+    return directives
+
+def parse_http_date(value):
+    try:
+        return email.utils.parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+class CacheEntry:
+    def __init__(self, headers, body, stored_at):
+        self.headers = headers
+        self.body = body
+        self.stored_at = stored_at
+
+    def freshness_lifetime(self):
+        directives = parse_cache_control(self.headers)
+        if "no-cache" in directives:
+            return 0
+        if "max-age" in directives:
+            try:
+                return int(directives["max-age"])
+            except ValueError:
+                return 0
+        if "expires" in self.headers:
+            expires = parse_http_date(self.headers["expires"])
+            if expires is None:
+                return 0
+            date = parse_http_date(self.headers.get("date", "")) \
+                or self.stored_at
+            return expires - date
+        return 0
+
+    def is_fresh(self, now):
+        age = now - self.stored_at
+        try:
+            age += int(self.headers.get("age", "0"))
+        except ValueError:
+            pass
+        return age < self.freshness_lifetime()
+
+    def validators(self):
+        validators = {}
+        if "etag" in self.headers:
+            validators["If-None-Match"] = self.headers["etag"]
+        if "last-modified" in self.headers:
+            validators["If-Modified-Since"] = self.headers["last-modified"]
+        return validators
+
+    def is_cacheable(self):
+        directives = parse_cache_control(self.headers)
+        if "no-store" in directives:
+            return False
+        # The cache is keyed by URL alone, so it can't tell variants apart.
+        if "vary" in self.headers:
+            return False
+        return self.freshness_lifetime() > 0 or bool(self.validators())
+
+MAX_MEMORY_CACHE_ENTRIES = 256
+DECODED_BODY_HEADERS = ["content-encoding", "content-length",
+    "transfer-encoding"]
+
+class Stats:
+    def __init__(self, *names):
+        self.lock = threading.Lock()
+        for name in names:
+            setattr(self, name, 0)
+
+    def count(self, name, n=1):
+        with self.lock:
+            setattr(self, name, getattr(self, name) + n)
+
+class LRUCache(Stats):
+    def __init__(self, name, max_entries, *names):
+        super().__init__("hits", "misses", *names)
+        self.name = name
+        self.entries = collections.OrderedDict()
+        self.max_entries = max_entries
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None:
+                self.entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def pop(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def lookup(self, key, compute):
+        value = self.get(key)
+        if value is not None:
+            self.count("hits")
+            return value
+        self.count("misses")
+        value = compute()
+        self.put(key, value)
+        return value
+
+    def text(self):
+        with self.lock:
+            return "{}: {} hits, {} misses, {} entries".format(
+                self.name, self.hits, self.misses, len(self.entries))
+
+class HTTPCache(LRUCache):
+    def __init__(self, max_entries=MAX_MEMORY_CACHE_ENTRIES, disk_dir=None):
+        super().__init__("HTTP cache", max_entries,
+            "revalidations", "not_modified")
+        self.disk_dir = disk_dir
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+
+    def disk_path(self, url):
+        name = hashlib.sha256(url.encode("utf8")).hexdigest()
+        return os.path.join(self.disk_dir, name)
+
+    def entry(self, url):
+        entry = self.get(url)
+        if not entry and self.disk_dir:
+            try:
+                with open(self.disk_path(url)) as f:
+                    data = json.load(f)
+            except (OSError, ValueError):
+                return None
+            if data.get("url") != url:
+                return None
+            entry = CacheEntry(
+                data["headers"], data["body"], data["stored_at"])
+            self.put(url, entry)
+        return entry
+
+    def store(self, url, headers, body):
+        # The body is stored decoded, so its framing and encoding
+        # headers no longer apply.
+        headers = {name: value for name, value in headers.items()
+            if name not in DECODED_BODY_HEADERS}
+        entry = CacheEntry(headers, body, time.time())
+        if not entry.is_cacheable():
+            self.evict(url)
+            return entry
+        self.put(url, entry)
+        if self.disk_dir:
+            with open(self.disk_path(url), "w") as f:
+                json.dump({
+                    "url": url,
+                    "headers": headers,
+                    "body": body,
+                    "stored_at": entry.stored_at,
+                }, f)
+        return entry
+
+    def refresh(self, url, entry, headers):
+        self.count("not_modified")
+        new_headers = dict(entry.headers)
+        for name in ["cache-control", "expires", "date", "etag",
+            "last-modified", "age"]:
+            if name in headers:
+                new_headers[name] = headers[name]
+            elif name == "age":
+                new_headers.pop(name, None)
+        return self.store(url, new_headers, entry.body)
+
+    def evict(self, url):
+        self.pop(url)
+        if self.disk_dir:
+            try:
+                os.remove(self.disk_path(url))
+            except OSError:
+                pass
+
+    def text(self):
+        return ("HTTP cache: {} hits, {} misses, " +
+            "{} revalidations ({} not modified)").format(
+            self.hits, self.misses, self.revalidations, self.not_modified)
+
+HTTP_CACHE = HTTPCache()
+
+class HTTPRequest:
+    def __init__(self, url, top_level_url, payload=None):
+        self.url = url
+        self.top_level_url = top_level_url
+        self.payload = payload
+        self.method = "POST" if payload else "GET"
+        self.cache_entry = None
+        self.timing = RequestTiming(self.method, url)
+
+        scheme, url = url.split("://", 1)
+        assert scheme in ["http", "https"], \
+            "Unknown scheme {}".format(scheme)
+
+        if "/" not in url:
+            url = url + "/"
+        host, path = url.split("/", 1)
+
+        self.scheme = scheme
+        self.path = "/" + path
+        self.port = 80 if scheme == "http" else 443
+
+        if ":" in host:
+            host, port = host.split(":", 1)
+            self.port = int(port)
+        self.host = host
+
+    def cacheable(self):
+        # Responses to requests with cookies may be personalized.
+        return self.method == "GET" and not self.cookie()
+
+    def cached_response(self):
+        if not self.cacheable(): return None
+        entry = HTTP_CACHE.entry(self.url)
+        if entry and entry.is_fresh(time.time()):
+            HTTP_CACHE.count("hits")
+            return Response(self.url, "200", entry.headers, text=entry.body,
+                timing=self.timing)
+        if entry and entry.validators():
+            HTTP_CACHE.count("revalidations")
+            self.cache_entry = entry
+        else:
+            HTTP_CACHE.count("misses")
+        return None
+
+    def cookie(self):
+        if self.host not in COOKIE_JAR: return None
+        cookie, params = COOKIE_JAR[self.host]
+        if self.top_level_url and \
+            params.get("samesite", "none") == "lax":
+            _, _, top_level_host, _ = self.top_level_url.split("/", 3)
+            if ":" in top_level_host:
+                top_level_host, _ = top_level_host.split(":", 1)
+            if self.host != top_level_host and self.method != "GET":
+                return None
+        return cookie
+
+    def encode(self):
+        body = "{} {} HTTP/1.1\r\n".format(self.method, self.path)
+        body += "Host: {}\r\n".format(self.host)
+        body += "Connection: keep-alive\r\n"
+        body += "Accept-Encoding: gzip, deflate\r\n"
+        cookie = self.cookie()
+        if cookie:
+            body += "Cookie: {}\r\n".format(cookie)
+        if self.payload:
+            content_length = len(self.payload.encode("utf8"))
+            body += "Content-Length: {}\r\n".format(content_length)
+        if self.cache_entry:
+            for header, value in self.cache_entry.validators().items():
+                body += "{}: {}\r\n".format(header, value)
+        body += "\r\n" + (self.payload or "")
+        return body.encode("utf8")
+
+    def parse_statusline(self, statusline):
+        version, status, explanation = \
+            statusline.decode("utf8").split(" ", 2)
+        assert status == "200" or \
+            (status == "304" and self.cache_entry), \
+            "{}: {}".format(status, explanation)
+        return version, status
+
+    def parse_header(self, line, headers):
+        header, value = line.decode("utf8").split(":", 1)
+        headers[header.lower()] = value.strip()
+
+    def save_cookies(self, headers):
+        if "set-cookie" in headers:
+            params = {}
+            if ";" in headers["set-cookie"]:
+                cookie, rest = headers["set-cookie"].split(";", 1)
+                for param_pair in rest.split(";"):
+                    if '=' in param_pair:
+                        name, value = param_pair.strip().split("=", 1)
+                        params[name.lower()] = value.lower()
+            else:
+                cookie = headers["set-cookie"]
+            COOKIE_JAR[self.host] = (cookie, params)
+
+    def response(self, status, headers, body):
+        if status == "304":
+            for data in body: pass
+            entry = HTTP_CACHE.refresh(self.url, self.cache_entry, headers)
+            return Response(self.url, "200", entry.headers, text=entry.body,
+                timing=self.timing)
+        if self.method != "GET":
+            HTTP_CACHE.evict(self.url)
+        return Response(self.url, status, headers, body=body,
+            cache_key=self.url if self.cacheable() else None,
+            timing=self.timing)
+
+MAX_CONNECTIONS_PER_ORIGIN = 6
+USE_NETWORK_THREAD = True
+HAR_FILE = None
+
+PRIORITY_DOCUMENT = 0
+PRIORITY_STYLE = 1
+PRIORITY_SCRIPT = 2
+PRIORITY_LOW = 3
+PRIORITY_NAMES = ["document", "style", "script", "low"]
+
+class FetchScheduler:
+    def __init__(self, per_origin_limit=MAX_CONNECTIONS_PER_ORIGIN):
+        self.per_origin_limit = per_origin_limit
+        self.lock = threading.Lock()
+        self.active = {}
+        self.queues = {}
+        self.order = itertools.count()
+        self.max_queue_depth = 0
+        self.requests = [0 for name in PRIORITY_NAMES]
+        self.total_wait = [0 for name in PRIORITY_NAMES]
+        self.max_wait = [0 for name in PRIORITY_NAMES]
+
+    def queue_depth(self):
+        return sum([len(queue) for queue in self.queues.values()])
+
+    def record_wait(self, priority, queued_at):
+        wait = time.time() - queued_at
+        self.requests[priority] += 1
+        self.total_wait[priority] += wait
+        self.max_wait[priority] = max(self.max_wait[priority], wait)
+
+    def enqueue(self, origin, priority, wake):
+        queued_at = time.time()
+        with self.lock:
+            queue = self.queues.setdefault(origin, [])
+            if not queue and \
+                self.active.get(origin, 0) < self.per_origin_limit:
+                self.active[origin] = self.active.get(origin, 0) + 1
+                self.record_wait(priority, queued_at)
+                return True
+            heapq.heappush(queue,
+                (priority, next(self.order), queued_at, wake))
+            self.max_queue_depth = max(
+                self.max_queue_depth, self.queue_depth())
+            return False
+
+    async def acquire(self, origin, priority):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        def grant():
+            if future.cancelled():
+                self.release(origin)
+            else:
+                future.set_result(None)
+        if self.enqueue(origin, priority,
+            lambda: loop.call_soon_threadsafe(grant)):
+            return
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.release(origin)
+            raise
+
+    def acquire_blocking(self, origin, priority):
+        granted = threading.Event()
+        if not self.enqueue(origin, priority, granted.set):
+            granted.wait()
+
+    def release(self, origin):
+        with self.lock:
+            queue = self.queues.get(origin, [])
+            if not queue:
+                self.active[origin] -= 1
+                return
+            priority, order, queued_at, wake = heapq.heappop(queue)
+            self.record_wait(priority, queued_at)
+        # The connection slot passes straight to the waiter.
+        wake()
+
+    def text(self):
+        waits = ["{} {} (avg {:>.0f}ms, max {:>.0f}ms)".format(
+            self.requests[priority], name,
+            self.total_wait[priority] / max(self.requests[priority], 1)
+                * 1000,
+            self.max_wait[priority] * 1000)
+            for priority, name in enumerate(PRIORITY_NAMES)]
+        return "Fetch scheduler: {}; {} queued, max queue depth {}".format(
+            ", ".join(waits), self.queue_depth(), self.max_queue_depth)
+
+def fetch(url, top_level_url, payload=None, priority=PRIORITY_LOW):
+    req = HTTPRequest(url, top_level_url, payload)
+    cached = req.cached_response()
+    if cached: return cached
+    if USE_NETWORK_THREAD:
+        return NETWORK.fetch_blocking(req, priority)
+
+    origin = (req.scheme, req.host, req.port)
+    NETWORK.scheduler.acquire_blocking(origin, priority)
+    req.timing.mark("queued")
+    try:
+        conn = CONNECTION_POOL.get(
+            req.scheme, req.host, req.port, req.timing)
+        try:
+            response = conn.send(req.encode())
+            req.timing.mark("sent")
+            statusline = response.readline()
+        except OSError:
+            if not conn.reused: raise
+            statusline = b""
+        if not statusline and conn.reused:
+            # The server closed the idle connection; retry on a fresh
+            # one.
+            conn.close()
+            conn = HTTPConnection(
+                req.scheme, req.host, req.port, req.timing)
+            response = conn.send(req.encode())
+            req.timing.mark("sent")
+            statusline = response.readline()
+        req.timing.mark("first_byte")
+
+        try:
+            version, status = req.parse_statusline(statusline)
+            headers = {}
+            while True:
+                line = response.readline()
+                if line in [b"\r\n", b"\n", b""]: break
+                req.parse_header(line, headers)
+        except:
+            conn.close()
+            raise
+    except:
+        NETWORK.scheduler.release(origin)
+        raise
+    req.save_cookies(headers)
+
+    response_body = ResponseBody(response, status, headers)
+    def read_and_release():
+        try:
+            yield from response_body
+            req.timing.mark("last_byte")
+        finally:
+            if response_body.framed and keep_alive(version, headers):
+                conn.save_tls_session()
+                CONNECTION_POOL.put(conn)
+            else:
+                conn.close()
+            NETWORK.scheduler.release(origin)
+    return req.response(status, headers, read_and_release())
+
+def request(url, top_level_url, payload=None):
+    response = fetch(url, top_level_url, payload)
+    return response.headers, response.read()
+
+def fetch_and_read(url, top_level_url, payload=None,
+    priority=PRIORITY_LOW):
+    response = fetch(url, top_level_url, payload, priority)
+    return response, response.read()
+
+async def read_body_async(reader, status, headers):
+    if status.startswith("1") or status in ["204", "304"]:
+        return [], True
+    # A truncated body raises IncompleteReadError, like the EOFError
+    # ResponseBody raises, so it never reaches the cache.
+    if headers.get("transfer-encoding", "").lower() == "chunked":
+        chunks = []
+        while True:
+            size_line = await reader.readline()
+            size = int(size_line.split(b";", 1)[0].strip(), 16)
+            if size == 0: break
+            chunks.append(await reader.readexactly(size))
+            await reader.readline()
+        while True:
+            line = await reader.readline()
+            if line in [b"\r\n", b"\n", b""]: break
+        return chunks, True
+    elif "content-length" in headers:
+        length = int(headers["content-length"])
+        return [await reader.readexactly(length)], True
+    else:
+        return [await reader.read()], False
+
+class StreamReaderFile:
+    # Lets ResponseBody read an asyncio stream from another thread.
+    def __init__(self, reader, loop):
+        self.reader = reader
+        self.loop = loop
+
+    def run(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(
+            coroutine, self.loop).result()
+
+    def readline(self):
+        return self.run(self.reader.readline())
+
+    def read1(self, size):
+        return self.run(self.reader.read(size))
+
+class NetworkEngine:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.loop = None
+        self.thread = None
+        self.scheduler = FetchScheduler()
+        self.idle = {}
+
+    def start(self):
+        self.lock.acquire(blocking=True)
+        if not self.loop:
+            self.loop = asyncio.new_event_loop()
+            self.thread = threading.Thread(
+                target=self.loop.run_forever, daemon=True)
+            self.thread.start()
+        self.lock.release()
+
+    async def open_connection(self, req):
+        loop = asyncio.get_running_loop()
+        host, port = req.host, req.port
+        if USE_CONNECTION_CACHES:
+            host, port = await loop.run_in_executor(
+                None, DNS_CACHE.resolve, req.host, req.port)
+            req.timing.mark("dns")
+        sock = socket.socket(
+            family=socket.AF_INET,
+            type=socket.SOCK_STREAM,
+            proto=socket.IPPROTO_TCP,
+        )
+        sock.setblocking(False)
+        try:
+            await loop.sock_connect(sock, (host, port))
+        except:
+            sock.close()
+            raise
+        req.timing.mark("connect")
+        if req.scheme == "https":
+            ctx = await loop.run_in_executor(None, tls_context)
+            session = None
+            if USE_CONNECTION_CACHES:
+                session = TLS_SESSIONS.get((req.host, req.port))
+            if session:
+                ctx = TLSSessionContext(ctx, session)
+            connection = await asyncio.open_connection(sock=sock,
+                ssl=ctx, server_hostname=req.host)
+            req.timing.mark("tls")
+            return connection
+        else:
+            return await asyncio.open_connection(sock=sock)
+
+    async def get_connection(self, req):
+        key = (req.scheme, req.host, req.port)
+        idle = self.idle.get(key, [])
+        while idle:
+            reader, writer, last_used = idle.pop()
+            if time.time() - last_used < IDLE_CONNECTION_TIMEOUT_SEC \
+                and not writer.is_closing():
+                return reader, writer, True
+            writer.close()
+        reader, writer = await self.open_connection(req)
+        return reader, writer, False
+
+    def save_tls_session(self, req, writer):
+        ssl_object = writer.get_extra_info("ssl_object")
+        if ssl_object and ssl_object.session and USE_CONNECTION_CACHES:
+            TLS_SESSIONS[(req.host, req.port)] = ssl_object.session
+
+    def put_connection(self, req, reader, writer):
+        idle = self.idle.setdefault((req.scheme, req.host, req.port), [])
+        if len(idle) < MAX_IDLE_CONNECTIONS_PER_HOST:
+            idle.append((reader, writer, time.time()))
+        else:
+            writer.close()
+
+    def release_connection(self, req, reader, writer, reuse):
+        self.save_tls_session(req, writer)
+        if reuse:
+            self.put_connection(req, reader, writer)
+        else:
+            writer.close()
+
+    async def send(self, req, reader, writer):
+        writer.write(req.encode())
+        await writer.drain()
+        req.timing.mark("sent")
+        statusline = await reader.readline()
+        req.timing.mark("first_byte")
+        return statusline
+
+    async def open_response(self, req, priority):
+        origin = (req.scheme, req.host, req.port)
+        await self.scheduler.acquire(origin, priority)
+        req.timing.mark("queued")
+        try:
+            reader, writer, reused = await self.get_connection(req)
+            try:
+                statusline = await self.send(req, reader, writer)
+            except OSError:
+                if not reused: raise
+                statusline = b""
+            if not statusline and reused:
+                # The server closed the idle connection; retry on a
+                # fresh one.
+                writer.close()
+                reader, writer = await self.open_connection(req)
+                statusline = await self.send(req, reader, writer)
+
+            try:
+                version, status = req.parse_statusline(statusline)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in [b"\r\n", b"\n", b""]: break
+                    req.parse_header(line, headers)
+            except:
+                writer.close()
+                raise
+        except:
+            self.scheduler.release(origin)
+            raise
+        return reader, writer, version, status, headers
+
+    def fetch_blocking(self, req, priority):
+        # Streams the body to a thread outside the event loop, over the
+        # same keep-alive connections as asynchronous fetches.
+        self.start()
+        origin = (req.scheme, req.host, req.port)
+        reader, writer, version, status, headers = \
+            asyncio.run_coroutine_threadsafe(
+                self.open_response(req, priority), self.loop).result()
+        req.save_cookies(headers)
+
+        response_body = ResponseBody(
+            StreamReaderFile(reader, self.loop), status, headers)
+        def read_and_release():
+            try:
+                yield from response_body
+                req.timing.mark("last_byte")
+            finally:
+                reuse = response_body.framed and keep_alive(version, headers)
+                def release():
+                    self.release_connection(req, reader, writer, reuse)
+                    self.scheduler.release(origin)
+                self.loop.call_soon_threadsafe(release)
+        return req.response(status, headers, read_and_release())
+
+    async def fetch(self, url, top_level_url, payload=None,
+        priority=PRIORITY_LOW):
+        loop = asyncio.get_running_loop()
+        req = HTTPRequest(url, top_level_url, payload)
+        # The cache may read from disk, so it runs off the event loop.
+        cached = await loop.run_in_executor(None, req.cached_response)
+        if cached: return cached, cached.read()
+
+        origin = (req.scheme, req.host, req.port)
+        reader, writer, version, status, headers = \
+            await self.open_response(req, priority)
+        try:
+            try:
+                chunks, framed = await read_body_async(
+                    reader, status, headers)
+                req.timing.mark("last_byte")
+            except:
+                writer.close()
+                raise
+            self.release_connection(req, reader, writer,
+                framed and keep_alive(version, headers))
+        finally:
+            self.scheduler.release(origin)
+
+        def read_response():
+            req.save_cookies(headers)
+            response = req.response(status, headers, iter(chunks))
+            return response, response.read()
+        # Decompressing, decoding and caching the body all block.
+        return await loop.run_in_executor(None, read_response)
+
+    def submit(self, url, top_level_url, payload=None,
+        priority=PRIORITY_LOW):
+        if not USE_NETWORK_THREAD:
+            future = concurrent.futures.Future()
+            try:
+                future.set_result(fetch_and_read(
+                    url, top_level_url, payload, priority))
+            except Exception as e:
+                future.set_exception(e)
+            return future
+        self.start()
+        return asyncio.run_coroutine_threadsafe(
+            self.fetch(url, top_level_url, payload, priority), self.loop)
+
+    def request(self, url, top_level_url, payload=None):
+        response, body = self.submit(url, top_level_url, payload).result()
+        return response.headers, body
+
+NETWORK = NetworkEngine()
+
+USE_PROGRESSIVE_RENDERING = True
+PROGRESSIVE_RENDER_INTERVAL_SEC = 0.05
+
+PRELOAD_PRIORITIES = {
+    "style": PRIORITY_STYLE,
+    "script": PRIORITY_SCRIPT,
+}
+
+class PreloadScanner:
+    TAG = re.compile(r"<(script|link|img)(\s[^>]*)?>", re.IGNORECASE)
+
+    def __init__(self):
+        self.buffer = ""
+
+    def get_attributes(self, text):
+        attributes = {}
+        for attrpair in text.split():
+            if "=" in attrpair:
+                key, value = attrpair.split("=", 1)
+                if len(value) > 2 and value[0] in ["'", "\""]:
+                    value = value[1:-1]
+                attributes[key.lower()] = value
+            else:
+                attributes[attrpair.lower()] = ""
+        return attributes
+
+    def feed(self, chunk):
+        text = self.buffer + chunk
+        found = []
+        end = 0
+        for match in self.TAG.finditer(text):
+            end = match.end()
+            tag = match.group(1).lower()
+            attributes = self.get_attributes(match.group(2) or "")
+            if tag == "script" and "src" in attributes:
+                found.append(("script", attributes["src"]))
+            elif tag == "link" and "href" in attributes \
+                and attributes.get("rel") == "stylesheet":
+                found.append(("style", attributes["href"]))
+            elif tag == "img" and "src" in attributes:
+                found.append(("image", attributes["src"]))
+        # Keep a tag that is split across chunks for the next call.
+        start = text.rfind("<", end)
+        if start >= 0 and text.find(">", start) < 0:
+            self.buffer = text[start:]
+        else:
+            self.buffer = ""
+        return found
+
+SHOW_CACHE_STATS = False
+
 class MeasureTime:
     def __init__(self, name):
         self.name = name
@@ -160,16 +1314,20 @@ class Transform(DisplayItem):
             (x, y) = self.translation
             return "Transform(translate({}, {}))".format(x, y)
 
+@functools.lru_cache(maxsize=256)
+def resolve_color(color):
+    return parse_color(color)
+
 class DrawRRect(DisplayItem):
     def __init__(self, rect, radius, color):
         super().__init__(rect=rect)
         self.rrect = skia.RRect.MakeRectXY(rect, radius, radius)
         self.color = color
+        self.sk_color = resolve_color(color)
 
     def execute(self, canvas):
-        sk_color = parse_color(self.color)
         canvas.drawRRect(self.rrect,
-            paint=skia.Paint(Color=sk_color))
+            paint=skia.Paint(Color=self.sk_color))
 
     def print(self, indent=0):
         return " " * indent + self.__repr__()
@@ -187,12 +1345,14 @@ class DrawText(DisplayItem):
         self.font = font
         self.text = text
         self.color = color
+        self.sk_color = resolve_color(color)
         super().__init__(
             rect=skia.Rect.MakeLTRB(x1, y1, self.right, self.bottom))
 
     def execute(self, canvas):
-        draw_text(canvas, self.left, self.top,
-            self.text, self.font, self.color)
+        paint = skia.Paint(AntiAlias=True, Color=self.sk_color)
+        canvas.drawString(self.text, float(self.left),
+            self.top - self.font.getMetrics().fAscent, self.font, paint)
 
     def __repr__(self):
         return "DrawText(text={})".format(self.text)
@@ -285,6 +1445,7 @@ class SaveLayer(DisplayItem):
         else:
             return "SaveLayer(alpha={})".format(self.sk_paint.getAlphaf())
 
+@functools.lru_cache(maxsize=1024)
 def parse_transform(transform_str):
     if transform_str.find('translate') < 0:
         return None
@@ -296,6 +1457,304 @@ def parse_transform(transform_str):
 
 USE_COMPOSITING = True
 
+class Attributes(collections.abc.MutableMapping):
+    __slots__ = ["key", "value", "others"]
+
+    def __init__(self, pairs=None):
+        self.key = None
+        self.value = None
+        self.others = None
+        if pairs:
+            for key, value in pairs.items():
+                self[key] = value
+
+    def __getitem__(self, key):
+        if self.others is not None: return self.others[key]
+        if key == self.key and key is not None: return self.value
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        if self.others is not None: return self.others.get(key, default)
+        if key == self.key and key is not None: return self.value
+        return default
+
+    def __contains__(self, key):
+        if self.others is not None: return key in self.others
+        return key == self.key and key is not None
+
+    def __setitem__(self, key, value):
+        key = sys.intern(key)
+        if self.others is not None:
+            self.others[key] = value
+        elif self.key is None or self.key == key:
+            self.key = key
+            self.value = value
+        else:
+            self.others = {self.key: self.value, key: value}
+            self.key = None
+            self.value = None
+
+    def __delitem__(self, key):
+        if self.others is not None:
+            del self.others[key]
+        elif key == self.key and key is not None:
+            self.key = None
+            self.value = None
+        else:
+            raise KeyError(key)
+
+    def __iter__(self):
+        if self.others is not None: return iter(self.others)
+        return iter([] if self.key is None else [self.key])
+
+    def __len__(self):
+        if self.others is not None: return len(self.others)
+        return 0 if self.key is None else 1
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+class Text:
+    __slots__ = ["text", "parent", "style", "style_dirty", "child_dirty"]
+    children = ()
+
+    def __init__(self, text, parent):
+        self.text = text
+        self.parent = parent
+        self.style_dirty = True
+        self.child_dirty = False
+
+    def __repr__(self):
+        return repr(self.text)
+
+class Element:
+    __slots__ = ["tag", "attributes", "children", "parent", "style",
+        "style_dirty", "child_dirty", "transform", "save_layer"]
+
+    def __init__(self, tag, attributes, parent):
+        self.tag = sys.intern(tag)
+        self.attributes = Attributes(attributes)
+        self.children = []
+        self.parent = parent
+        self.style_dirty = True
+        self.child_dirty = False
+
+    def __repr__(self):
+        attrs = [" " + k + "=\"" + v + "\"" for k, v  in self.attributes.items()]
+        return "<" + self.tag + "".join(attrs) + ">"
+
+# lab5's layout_mode checks for lab4's Text class. Subclassing it would
+# give every node a __dict__ again, so this version checks for ours.
+def layout_mode(node):
+    if isinstance(node, Text):
+        return "inline"
+    elif node.children:
+        for child in node.children:
+            if isinstance(child, Text): continue
+            if child.tag in BLOCK_ELEMENTS:
+                return "block"
+        return "inline"
+    else:
+        return "block"
+
+class TagSelector(lab6.TagSelector):
+    def matches(self, node, ancestors=None):
+        return isinstance(node, Element) and self.tag == node.tag
+
+def selector_tags(selector):
+    if isinstance(selector, DescendantSelector):
+        return selector_tags(selector.ancestor) + \
+            selector_tags(selector.descendant)
+    elif isinstance(selector, TagSelector):
+        return [selector.tag]
+    return []
+
+ANCESTOR_FILTER_SIZE = 1024
+
+def ancestor_filter_slots(tag):
+    h = hash(tag)
+    return h % ANCESTOR_FILTER_SIZE, \
+        (h // ANCESTOR_FILTER_SIZE) % ANCESTOR_FILTER_SIZE
+
+class AncestorFilter:
+    def __init__(self):
+        self.counts = [0] * ANCESTOR_FILTER_SIZE
+        self.walks = 0
+        self.rejections = 0
+
+    def push(self, tag):
+        for slot in ancestor_filter_slots(tag):
+            self.counts[slot] += 1
+
+    def pop(self, tag):
+        for slot in ancestor_filter_slots(tag):
+            self.counts[slot] -= 1
+
+    def may_contain_all(self, slots):
+        counts = self.counts
+        for first, second in slots:
+            if not counts[first] or not counts[second]:
+                return False
+        return True
+
+class SelectorStats(Stats):
+    def __init__(self):
+        super().__init__("walks", "rejections")
+
+    def add(self, ancestors):
+        with self.lock:
+            self.walks += ancestors.walks
+            self.rejections += ancestors.rejections
+
+    def text(self):
+        return ("Descendant selectors: {} ancestor walks, " +
+            "{} avoided by the ancestor filter").format(
+            self.walks, self.rejections)
+
+SELECTOR_STATS = SelectorStats()
+
+class DescendantSelector(lab6.DescendantSelector):
+    def __init__(self, ancestor, descendant):
+        super().__init__(ancestor, descendant)
+        self.ancestor_slots = [ancestor_filter_slots(tag)
+            for tag in selector_tags(ancestor)]
+
+    def matches(self, node, ancestors=None):
+        if ancestors:
+            if not self.descendant.matches(node): return False
+            if not ancestors.may_contain_all(self.ancestor_slots):
+                ancestors.rejections += 1
+                return False
+            ancestors.walks += 1
+        return super().matches(node)
+
+class HTMLParser(lab4.HTMLParser):
+    def __init__(self, body=""):
+        super().__init__(body)
+        self.mode = "before html"
+        self.in_tag = False
+        self.pending = []
+
+    TOKEN = re.compile(r"([^<>]*)([<>])")
+
+    def parse(self):
+        self.feed(self.body)
+        return self.close()
+
+    def feed(self, chunk):
+        i = 0
+        for match in self.TOKEN.finditer(chunk):
+            text, delimiter = match.groups()
+            if self.pending:
+                # The token started in an earlier chunk.
+                self.pending.append(text)
+                text = "".join(self.pending)
+                self.pending = []
+            if delimiter == "<":
+                self.in_tag = True
+                if text: self.add_text(text)
+            else:
+                self.in_tag = False
+                self.add_tag(text)
+            i = match.end()
+        if i < len(chunk):
+            self.pending.append(chunk[i:])
+
+    def close(self):
+        text = "".join(self.pending)
+        self.pending = []
+        if not self.in_tag and text:
+            self.add_text(text)
+        return self.finish()
+
+    def parse_fragment(self, body, context):
+        context.children = []
+        self.unfinished = [context]
+        self.in_tag = False
+        self.pending = []
+        self.set_mode()
+        self.feed(body)
+        self.close()
+        return context.children
+
+    def partial_tree(self):
+        if not self.unfinished: return None
+        return self.unfinished[0]
+
+    def add_text(self, text):
+        # Like lab4's, but building this chapter's compact nodes.
+        if text.isspace(): return
+        self.implicit_tags(None)
+        parent = self.unfinished[-1]
+        node = Text(text, parent)
+        parent.children.append(node)
+
+    def add_tag(self, tag):
+        tag, attributes = self.get_attributes(tag)
+        if tag.startswith("!"): return
+        self.implicit_tags(tag)
+
+        if tag.startswith("/"):
+            if len(self.unfinished) == 1: return
+            self.unfinished.pop()
+            self.set_mode()
+        elif tag in self.SELF_CLOSING_TAGS:
+            parent = self.unfinished[-1]
+            node = Element(tag, attributes, parent)
+            parent.children.append(node)
+        else:
+            parent = self.unfinished[-1] if self.unfinished else None
+            node = Element(tag, attributes, parent)
+            # Open elements join the tree right away, so that the
+            # partial tree can be rendered while parsing continues.
+            if parent: parent.children.append(node)
+            self.unfinished.append(node)
+            self.set_mode()
+
+    def set_mode(self):
+        depth = len(self.unfinished)
+        if depth == 0:
+            self.mode = "before html"
+        elif self.unfinished[0].tag != "html" or depth > 2:
+            self.mode = "in element"
+        elif depth == 1:
+            self.mode = "before head"
+        elif self.unfinished[1].tag == "head":
+            self.mode = "in head"
+        else:
+            self.mode = "in body"
+
+    def implicit_tags(self, tag):
+        while True:
+            if self.mode == "before html" and tag != "html":
+                self.add_tag("html")
+            elif self.mode == "before head" \
+                 and tag not in ["head", "body", "/html"]:
+                if tag in self.HEAD_TAGS:
+                    self.add_tag("head")
+                else:
+                    self.add_tag("body")
+            elif self.mode == "in head" and tag != "/head" \
+                 and tag not in self.HEAD_TAGS:
+                self.add_tag("/head")
+            else:
+                break
+
+    def finish(self):
+        if len(self.unfinished) == 0:
+            self.add_tag("html")
+        root = self.unfinished[0]
+        self.unfinished = []
+        self.set_mode()
+        return root
+
+USE_FAST_CSS_PARSER = True
+
+# A selector word, with the same quoting rules as CSSParser.word.
+CSS_WORD = re.compile(r"""(?:[^\W_]|[,/#\-.%()"]|'(?:[^\W_]|[,/#\-.%()":])*')*""" +
+    r"""(?:'(?:[^\W_]|[,/#\-.%()":])*)?""")
+CSS_DECLARATION = re.compile(r"""([\w,/#\-.%()"]+)\s*:\s*(.*)""", re.S)
+
 class CSSParser:
     def __init__(self, s):
         self.s = s
@@ -348,7 +1807,46 @@ class CSSParser:
             else:
                 self.i += 1
 
+    def fast_body(self):
+        end = self.s.find("}", self.i)
+        if end < 0: end = len(self.s)
+        *declarations, rest = self.s[self.i:end].split(";")
+        if rest and not rest.isspace():
+            if end < len(self.s): return None
+            declarations.append(rest)
+        pairs = {}
+        for n, declaration in enumerate(declarations):
+            if n > 0: declaration = declaration.lstrip()
+            match = CSS_DECLARATION.fullmatch(declaration)
+            if not match or "_" in match.group(1): return None
+            pairs[match.group(1).lower()] = match.group(2)
+        self.i = end
+        return pairs
+
+    def fast_rule(self):
+        start = self.s.find("{", self.i)
+        if start < 0: return None
+        words = self.s[self.i:start].split()
+        if not words: return None
+        for word in words:
+            if not CSS_WORD.fullmatch(word): return None
+        i = self.i
+        self.i = start + 1
+        self.whitespace()
+        body = self.fast_body()
+        if body == None or self.i == len(self.s):
+            self.i = i
+            return None
+        self.i += 1
+        out = TagSelector(words[0].lower())
+        for word in words[1:]:
+            out = DescendantSelector(out, TagSelector(word.lower()))
+        return out, body
+
     def body(self):
+        if USE_FAST_CSS_PARSER:
+            pairs = self.fast_body()
+            if pairs != None: return pairs
         pairs = {}
         while self.i < len(self.s) and self.s[self.i] != "}":
             try:
@@ -379,6 +1877,11 @@ class CSSParser:
     def parse(self):
         rules = []
         while self.i < len(self.s):
+            if USE_FAST_CSS_PARSER:
+                rule = self.fast_rule()
+                if rule:
+                    rules.append(rule)
+                    continue
             try:
                 self.whitespace()
                 selector = self.selector()
@@ -439,11 +1942,9 @@ class BlockLayout:
         rect = skia.Rect.MakeLTRB(
             self.x, self.y,
             self.x + self.width, self.y + self.height)
-        bgcolor = self.node.style.get("background-color",
-                                 "transparent")
-        if bgcolor != "transparent":
-            radius = float(
-                self.node.style.get("border-radius", "0px")[:-2])
+        if self.node.style.background_color != None:
+            bgcolor = self.node.style["background-color"]
+            radius = self.node.style.border_radius
             cmds.append(DrawRRect(rect, radius, bgcolor))
 
         for child in self.children:
@@ -509,10 +2010,7 @@ class InlineLayout:
         self.children.append(new_line)
 
     def text(self, node):
-        weight = node.style["font-weight"]
-        style = node.style["font-style"]
-        size = float(node.style["font-size"][:-2])
-        font = get_font(size, weight, size)
+        font = node.style.font
         for word in node.text.split():
             w = font.measureText(word)
             if self.cursor_x + w > self.x + self.width:
@@ -531,10 +2029,7 @@ class InlineLayout:
         input = InputLayout(node, line, self.previous_word)
         line.children.append(input)
         self.previous_word = input
-        weight = node.style["font-weight"]
-        style = node.style["font-style"]
-        size = float(node.style["font-size"][:-2])
-        font = get_font(size, weight, size)
+        font = node.style.font
         self.cursor_x += w + font.measureText(" ")
 
     def paint(self, display_list):
@@ -544,10 +2039,9 @@ class InlineLayout:
             self.x, self.y, self.x + self.width,
             self.y + self.height)
 
-        bgcolor = self.node.style.get("background-color",
-                                 "transparent")
-        if bgcolor != "transparent":
-            radius = float(self.node.style.get("border-radius", "0px")[:-2])
+        if self.node.style.background_color != None:
+            bgcolor = self.node.style["background-color"]
+            radius = self.node.style.border_radius
             cmds.append(DrawRRect(rect, radius, bgcolor))
  
         for child in self.children:
@@ -646,11 +2140,7 @@ class TextLayout:
         self.font = None
 
     def layout(self):
-        weight = self.node.style["font-weight"]
-        style = self.node.style["font-style"]
-        if style == "normal": style = "roman"
-        size = float(self.node.style["font-size"][:-2])
-        self.font = get_font(size, weight, style)
+        self.font = self.node.style.font
 
         # Do not set self.y!!!
         self.width = self.font.measureText(self.word)
@@ -664,9 +2154,9 @@ class TextLayout:
         self.height = linespace(self.font)
 
     def paint(self, display_list):
-        color = self.node.style["color"]
         display_list.append(
-            DrawText(self.x, self.y, self.word, self.font, color))
+            DrawText(self.x, self.y, self.word, self.font,
+                self.node.style["color"]))
     
     def __repr__(self):
         return "TextLayout(x={}, y={}, width={}, height={}".format(
@@ -685,11 +2175,7 @@ class InputLayout:
         self.font = None
 
     def layout(self):
-        weight = self.node.style["font-weight"]
-        style = self.node.style["font-style"]
-        if style == "normal": style = "roman"
-        size = float(self.node.style["font-size"][:-2])
-        self.font = get_font(size, weight, style)
+        self.font = self.node.style.font
 
         self.width = style_length(
             self.node, "width", INPUT_WIDTH_PX)
@@ -709,10 +2195,9 @@ class InputLayout:
             self.x, self.y, self.x + self.width,
             self.y + self.height)
 
-        bgcolor = self.node.style.get("background-color",
-                                 "transparent")
-        if bgcolor != "transparent":
-            radius = float(self.node.style.get("border-radius", "0px")[:-2])
+        if self.node.style.background_color != None:
+            bgcolor = self.node.style["background-color"]
+            radius = self.node.style.border_radius
             cmds.append(DrawRRect(rect, radius, bgcolor))
 
         if self.node.tag == "input":
@@ -720,9 +2205,8 @@ class InputLayout:
         elif self.node.tag == "button":
             text = self.node.children[0].text
 
-        color = self.node.style["color"]
         cmds.append(DrawText(self.x, self.y,
-                             text, self.font, color))
+                             text, self.font, self.node.style["color"]))
 
         cmds = paint_visual_effects(self.node, cmds, rect)
         display_list.extend(cmds)
@@ -732,6 +2216,9 @@ class InputLayout:
             self.x, self.y, self.width, self.height)
 
 def style_length(node, style_name, default_value):
+    if isinstance(node.style, ComputedStyle):
+        length = getattr(node.style, style_name)
+        return default_value if length == None else length
     style_val = node.style.get(style_name)
     if style_val:
         return int(math.floor(float(style_val[:-2])))
@@ -739,17 +2226,17 @@ def style_length(node, style_name, default_value):
         return default_value
 
 def paint_visual_effects(node, cmds, rect):
-    opacity = float(node.style.get("opacity", "1.0"))
-    blend_mode = parse_blend_mode(node.style.get("mix-blend-mode"))
+    opacity = node.style.opacity
+    blend_mode = node.style.blend_mode
     translation = parse_transform(node.style.get("transform", ""))
 
-    border_radius = float(node.style.get("border-radius", "0px")[:-2])
-    if node.style.get("overflow", "visible") == "clip":
+    border_radius = node.style.border_radius
+    if node.style.clip:
         clip_radius = border_radius
     else:
         clip_radius = 0
 
-    needs_clip = node.style.get("overflow", "visible") == "clip"
+    needs_clip = node.style.clip
     needs_blend_isolation = blend_mode != skia.BlendMode.kSrcOver or \
         needs_clip or opacity != 1.0
 
@@ -795,6 +2282,9 @@ class JSContext:
 
         self.node_to_handle = {}
         self.handle_to_node = {}
+        self.fragment_parser = HTMLParser()
+        self.paused_tasks = None
+        self.discarded = False
 
     def run(self, script, code):
         try:
@@ -829,21 +2319,40 @@ class JSContext:
         return elt.attributes.get(attr, None)
 
     def innerHTML_set(self, handle, s):
-        doc = HTMLParser(
-            "<html><body>" + s + "</body></html>").parse()
-        new_nodes = doc.children[0].children
         elt = self.handle_to_node[handle]
-        elt.children = new_nodes
-        for child in elt.children:
-            child.parent = elt
+        self.fragment_parser.parse_fragment(s, elt)
+        mark_style_dirty(elt)
         self.tab.set_needs_render()
 
     def style_set(self, handle, s):
+        if self.handle_to_node[handle].attributes.get("style") == s:
+            return
         elt = self.handle_to_node[handle]
         elt.attributes["style"] = s;
+        mark_style_dirty(elt)
         self.tab.set_needs_render()
 
+    def pause(self):
+        self.paused_tasks = []
+
+    def resume(self):
+        tasks = self.paused_tasks or []
+        self.paused_tasks = None
+        for task in tasks:
+            self.tab.task_runner.schedule_task(task)
+
+    def discard(self):
+        self.paused_tasks = None
+        self.discarded = True
+
+    def defer(self, task):
+        if self.discarded: return True
+        if self.paused_tasks is None: return False
+        self.paused_tasks.append(task)
+        return True
+
     def dispatch_settimeout(self, handle):
+        if self.defer(Task(self.dispatch_settimeout, handle)): return
         self.interp.evaljs(SETTIMEOUT_CODE, handle=handle)
 
     def setTimeout(self, handle, time):
@@ -853,9 +2362,14 @@ class JSContext:
         threading.Timer(time / 1000.0, run_callback).start()
 
     def dispatch_xhr_onload(self, out, handle):
+        if self.defer(Task(self.dispatch_xhr_onload, out, handle)): return
         do_default = self.interp.evaljs(
             XHR_ONLOAD_CODE, out=out, handle=handle)
 
+    def dispatch_xhr_error(self, url, error):
+        if self.defer(Task(self.dispatch_xhr_error, url, error)): return
+        print("XHR", url, "failed", error)
+
     def XMLHttpRequest_send(self, method, url, body, isasync, handle):
         full_url = resolve_url(url, self.tab.url)
         if not self.tab.allowed_request(full_url):
@@ -864,18 +2378,29 @@ class JSContext:
             raise Exception(
                 "Cross-origin XHR request not allowed")
 
-        def run_load():
-            headers, response = request(
-                full_url, self.tab.url, payload=body)
-            task = Task(self.dispatch_xhr_onload, response, handle)
+        def run_load(fetch):
+            response, out = fetch.result()
+            task = Task(self.dispatch_xhr_onload, out, handle)
             self.tab.task_runner.schedule_task(task)
-            if not isasync:
-                return response
+            return out
 
+        def run_load_async(fetch):
+            # This runs on the network thread, so errors have to be
+            # handed back to the tab rather than raised.
+            try:
+                run_load(fetch)
+            except Exception as e:
+                task = Task(self.dispatch_xhr_error, full_url, e)
+                self.tab.task_runner.schedule_task(task)
+
+        # A synchronous XHR blocks its script, so it shouldn't wait
+        # behind background fetches.
+        fetch = NETWORK.submit(full_url, self.tab.url, payload=body,
+            priority=PRIORITY_LOW if isasync else PRIORITY_SCRIPT)
         if not isasync:
-            return run_load()
+            return run_load(fetch)
         else:
-            threading.Thread(target=run_load).start()
+            fetch.add_done_callback(run_load_async)
 
     def now(self):
         return int(time.time() * 1000)
@@ -961,33 +2486,291 @@ def try_numeric_animation(node, name,
         node, name, is_px, old_value, new_value,
         num_frames, tab)
 
+USE_RULE_INDEX = True
+USE_ANCESTOR_FILTER = True
+USE_STYLE_SHARING = True
+
+def rightmost_tag(selector):
+    while isinstance(selector, DescendantSelector):
+        selector = selector.descendant
+    if isinstance(selector, TagSelector):
+        return selector.tag
+    return None
+
+def depends_on_position(selector):
+    if isinstance(selector, DescendantSelector):
+        return depends_on_position(selector.ancestor) or \
+            depends_on_position(selector.descendant)
+    return not isinstance(selector, TagSelector)
+
+class RuleIndex:
+    def __init__(self, rules):
+        self.buckets = {}
+        self.universal = []
+        self.shareable = True
+        for order, (selector, body) in enumerate(rules):
+            if depends_on_position(selector):
+                self.shareable = False
+            rule = (order, selector, tuple(body.items()))
+            tag = rightmost_tag(selector) if USE_RULE_INDEX else None
+            if tag:
+                self.buckets.setdefault(tag, []).append(rule)
+            else:
+                self.universal.append(rule)
+
+    def candidates(self, node):
+        if isinstance(node, Element):
+            bucket = self.buckets.get(node.tag, [])
+        else:
+            bucket = []
+        if not self.universal: return bucket
+        if not bucket: return self.universal
+        # Keep the cascade order of the original rule list.
+        return heapq.merge(bucket, self.universal)
+
+MAX_INLINE_STYLE_ENTRIES = 4096
+
+class InlineStyleCache(LRUCache):
+    def __init__(self, max_entries=MAX_INLINE_STYLE_ENTRIES):
+        super().__init__("Inline style cache", max_entries)
+
+    def parse(self, s):
+        return self.lookup(s, lambda: tuple(CSSParser(s).body().items()))
+
+INLINE_STYLE_CACHE = InlineStyleCache()
+
+MAX_STYLE_SHEET_ENTRIES = 64
+
+class StyleSheetCache(LRUCache):
+    def __init__(self, max_entries=MAX_STYLE_SHEET_ENTRIES):
+        super().__init__("Style sheet cache", max_entries)
+
+    def parse(self, s):
+        key = hashlib.sha256(s.encode("utf8")).hexdigest()
+        return self.lookup(key, lambda: tuple([
+            (selector, types.MappingProxyType(body))
+            for selector, body in CSSParser(s).parse()]))
+
+STYLE_SHEET_CACHE = StyleSheetCache()
+
+@functools.lru_cache(maxsize=16)
+def load_style_sheet(path, mtime):
+    with open(path) as f:
+        return STYLE_SHEET_CACHE.parse(f.read())
+
+def default_style_sheet():
+    path = "browser8.css"
+    return load_style_sheet(path, os.stat(path).st_mtime_ns)
+
+STYLE_SHEET_VERSIONS = itertools.count(1)
+
+class CompiledStyleSheet:
+    def __init__(self, rules, version):
+        self.version = version
+        self.rules = sorted(rules, key=cascade_priority)
+        self.index = RuleIndex(self.rules)
+
+def parse_length(value):
+    if value and value.endswith("px"):
+        return int(math.floor(float(value[:-2])))
+    return None
+
+@functools.lru_cache(maxsize=256)
+def shared_font(size, weight, style):
+    return get_font(size, weight, style)
+
+class ComputedStyle(dict):
+    __slots__ = ["font_size", "font", "background_color",
+        "border_radius", "opacity", "blend_mode", "clip", "width", "height"]
+
+    def __init__(self, pairs=()):
+        super().__init__(pairs)
+        self.background_color = None
+        self.border_radius = 0.0
+        self.opacity = 1.0
+        self.blend_mode = skia.BlendMode.kSrcOver
+        self.clip = False
+        self.width = None
+        self.height = None
+        self.parse("font-size")
+        for property in TYPED_PROPERTIES.intersection(self):
+            self.parse(property)
+
+    def parse(self, property):
+        if property in ["font-size", "font-weight", "font-style"]:
+            self.font_size = float(self.get("font-size", "16px")[:-2])
+            style = self.get("font-style", "normal")
+            if style == "normal": style = "roman"
+            self.font = shared_font(
+                self.font_size, self.get("font-weight", "normal"), style)
+        elif property == "background-color":
+            bgcolor = self.get("background-color", "transparent")
+            if bgcolor == "transparent":
+                self.background_color = None
+            else:
+                self.background_color = resolve_color(bgcolor)
+        elif property == "border-radius":
+            self.border_radius = float(self.get("border-radius", "0px")[:-2])
+        elif property == "opacity":
+            self.opacity = float(self.get("opacity", "1.0"))
+        elif property == "mix-blend-mode":
+            self.blend_mode = parse_blend_mode(self.get("mix-blend-mode"))
+        elif property == "overflow":
+            self.clip = self.get("overflow", "visible") == "clip"
+        elif property == "width":
+            self.width = parse_length(self.get("width"))
+        elif property == "height":
+            self.height = parse_length(self.get("height"))
+
+    def __setitem__(self, property, value):
+        super().__setitem__(property, value)
+        self.parse(property)
+
+    def copy(self):
+        copy = ComputedStyle.__new__(ComputedStyle)
+        dict.update(copy, self)
+        for field in ComputedStyle.__slots__:
+            setattr(copy, field, getattr(self, field))
+        return copy
+
+TYPED_PROPERTIES = {"background-color", "border-radius", "opacity",
+    "mix-blend-mode", "overflow", "width", "height"}
+
+class SharedStyle(ComputedStyle):
+    __slots__ = []
+
+    def readonly(self, *args, **kwargs):
+        raise TypeError("shared computed styles are read-only")
+
+    __setitem__ = __delitem__ = readonly
+    clear = pop = popitem = setdefault = update = readonly
+
+def writable_style(node):
+    if isinstance(node.style, SharedStyle):
+        node.style = ComputedStyle.copy(node.style)
+    return node.style
+
+class StyleSharingStats(Stats):
+    def __init__(self):
+        super().__init__("computed", "shared")
+
+    def add(self, style_pass):
+        with self.lock:
+            self.computed += style_pass.computed
+            self.shared += style_pass.shared
+
+    def text(self):
+        return "Style sharing: {} styles computed, {} shared with a sibling" \
+            .format(self.computed, self.shared)
+
+STYLE_SHARING_STATS = StyleSharingStats()
+
+class StylePass:
+    def __init__(self, index, node):
+        self.index = index
+        self.siblings = None
+        if USE_STYLE_SHARING and index.shareable:
+            self.siblings = [{}]
+        self.computed = 0
+        self.shared = 0
+        self.ancestors = None
+        if USE_ANCESTOR_FILTER:
+            self.ancestors = AncestorFilter()
+            parent = node.parent
+            while parent:
+                self.ancestors.push(parent.tag)
+                parent = parent.parent
+
 def style(node, rules, tab):
+    if not isinstance(rules, StylePass):
+        if isinstance(rules, CompiledStyleSheet):
+            index = rules.index
+        else:
+            index = RuleIndex(rules)
+        style_pass = StylePass(index, node)
+        style(node, style_pass, tab)
+        if style_pass.ancestors:
+            SELECTOR_STATS.add(style_pass.ancestors)
+        if style_pass.siblings:
+            STYLE_SHARING_STATS.add(style_pass)
+        return
+
+    node.style_dirty = node.child_dirty = False
     old_style = None
-    if hasattr(node, 'style'):
+    if hasattr(node, 'style') and not (tab and tab.suppress_transitions):
         old_style = node.style
 
+    if rules.siblings:
+        if isinstance(node, Element):
+            key = (node.tag, node.attributes.get("style"))
+        else:
+            key = None
+        shared_style = rules.siblings[-1].get(key)
+        if shared_style is not None:
+            rules.shared += 1
+            node.style = shared_style
+            animate_style(node, old_style, node.style, tab)
+            style_children(node, rules, tab)
+            return
+    rules.computed += 1
+
     node.style = {}
     for property, default_value in INHERITED_PROPERTIES.items():
         if node.parent:
             node.style[property] = node.parent.style[property]
         else:
             node.style[property] = default_value
-    for selector, body in rules:
-        if not selector.matches(node): continue
-        for property, value in body.items():
+    for order, selector, body in rules.index.candidates(node):
+        if not selector.matches(node, rules.ancestors): continue
+        for property, value in body:
             computed_value = compute_style(node, property, value)
             if not computed_value: continue
             node.style[property] = computed_value
     if isinstance(node, Element) and "style" in node.attributes:
-        pairs = CSSParser(node.attributes["style"]).body()
-        for property, value in pairs.items():
+        pairs = INLINE_STYLE_CACHE.parse(node.attributes["style"])
+        for property, value in pairs:
             computed_value = compute_style(node, property, value)
             node.style[property] = computed_value
 
-    animate_style(node, old_style, node.style, tab)
+    if rules.siblings:
+        node.style = rules.siblings[-1][key] = SharedStyle(node.style)
+    else:
+        node.style = ComputedStyle(node.style)
 
-    for child in node.children:
-        style(child, rules, tab)
+    animate_style(node, old_style, node.style, tab)
+    style_children(node, rules, tab)
+
+def style_children(node, rules, tab):
+    if not node.children: return
+    if rules.siblings:
+        rules.siblings.append({})
+    if rules.ancestors and isinstance(node, Element):
+        rules.ancestors.push(node.tag)
+        for child in node.children:
+            style(child, rules, tab)
+        rules.ancestors.pop(node.tag)
+    else:
+        for child in node.children:
+            style(child, rules, tab)
+    if rules.siblings:
+        rules.siblings.pop()
+
+USE_INCREMENTAL_STYLE = True
+
+def mark_style_dirty(node):
+    node.style_dirty = True
+    parent = node.parent
+    while parent and not parent.child_dirty:
+        parent.child_dirty = True
+        parent = parent.parent
+
+def restyle_dirty(node, rules, tab):
+    if node.style_dirty:
+        style(node, rules, tab)
+    elif node.child_dirty:
+        node.child_dirty = False
+        for child in node.children:
+            restyle_dirty(child, rules, tab)
 
 class TranslateAnimation:
     def __init__(
@@ -1006,6 +2789,7 @@ class TranslateAnimation:
     def animate(self):
         self.frame_count += 1
         if self.frame_count >= self.num_frames: return False
+        writable_style(self.node)
         self.node.style["transform"] = \
             "translate({}px,{}px)".format(
                 self.old_x +
@@ -1034,6 +2818,7 @@ class NumericAnimation:
         if self.frame_count >= self.num_frames: return False
         updated_value = self.old_value + \
             self.change_per_frame * self.frame_count
+        writable_style(self.node)
         if self.is_px:
             self.node.style[self.property_name] = \
                 "{}px".format(updated_value)
@@ -1204,6 +2989,88 @@ def raster(display_list, canvas):
 def clamp_scroll(scroll, tab_height):
     return max(0, min(scroll, tab_height - (HEIGHT - CHROME_PX)))
 
+BACK_FORWARD_CACHE_ENTRIES = 3
+BACK_FORWARD_CACHE_BYTES = 64 * 1024 * 1024
+ESTIMATED_NODE_BYTES = 1024
+ESTIMATED_LAYOUT_OBJECT_BYTES = 512
+
+class CachedPage:
+    def __init__(self, tab):
+        self.url = tab.url
+        self.nodes = tab.nodes
+        self.rules = tab.rules
+        self.rules_version = tab.rules_version
+        self.style_sheet = tab.style_sheet
+        self.document = getattr(tab, "document", None)
+        self.js = tab.js
+        self.scroll = tab.scroll
+        self.scroll_behavior = tab.scroll_behavior
+        self.allowed_origins = tab.allowed_origins
+        self.responses = tab.responses
+        self.animations = tab.animations
+        self.size = self.estimate_size()
+
+    def estimate_size(self):
+        size = 0
+        for node in tree_to_list(self.nodes, []):
+            size += ESTIMATED_NODE_BYTES
+            if isinstance(node, Text):
+                size += len(node.text)
+        if self.document:
+            size += ESTIMATED_LAYOUT_OBJECT_BYTES * \
+                len(tree_to_list(self.document, []))
+        return size
+
+    def restore(self, tab):
+        tab.url = self.url
+        tab.nodes = self.nodes
+        tab.rules = self.rules
+        tab.rules_version = self.rules_version
+        tab.style_sheet = self.style_sheet
+        tab.document = self.document
+        tab.js = self.js
+        tab.scroll = self.scroll
+        tab.scroll_behavior = self.scroll_behavior
+        tab.allowed_origins = self.allowed_origins
+        tab.responses = self.responses
+        tab.animations = self.animations
+
+class BackForwardCache:
+    def __init__(self, max_entries=BACK_FORWARD_CACHE_ENTRIES,
+        max_bytes=BACK_FORWARD_CACHE_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.pages = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def size(self):
+        return sum([page.size for page in self.pages.values()])
+
+    def put(self, index, page):
+        page.js.pause()
+        self.pages[index] = page
+        self.pages.move_to_end(index)
+        while self.pages and (len(self.pages) > self.max_entries
+            or self.size() > self.max_bytes):
+            _, evicted = self.pages.popitem(last=False)
+            evicted.js.discard()
+            self.evictions += 1
+
+    def take(self, index):
+        page = self.pages.pop(index, None)
+        if page:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return page
+
+    def text(self):
+        return ("Back/forward cache: {} hits, {} misses, {} evictions, " +
+            "{} pages ({} bytes) cached").format(self.hits, self.misses,
+            self.evictions, len(self.pages), self.size())
+
 class Tab:
     def __init__(self, browser):
         self.history = []
@@ -1223,14 +3090,24 @@ class Tab:
         self.task_runner.start()
 
         self.measure_render = MeasureTime("render")
+        self.responses = []
+        self.preloads = {}
+        self.style_preloads = []
+        self.parser = None
+        self.suppress_transitions = True
+        self.back_forward_cache = BackForwardCache()
+        self.rules = []
+        self.rules_version = next(STYLE_SHEET_VERSIONS)
+        self.style_sheet = None
+        self.styled_nodes = None
+        self.styled_version = None
 
         self.animations = {}
         self.composited_animation_updates = []
         self.scroll_behavior = 'auto'
         self.scroll_animation = None
 
-        with open("browser8.css") as f:
-            self.default_style_sheet = CSSParser(f.read()).parse()
+        self.default_style_sheet = default_style_sheet()
 
     def allowed_request(self, url):
         return self.allowed_origins == None or \
@@ -1239,56 +3116,189 @@ class Tab:
     def script_run_wrapper(self, script, script_text):
         return Task(self.js.run, script, script_text)
 
-    def load(self, url, body=None):
+    def load(self, url, body=None, cache_page=True):
+        response = fetch(url, self.url, payload=body,
+            priority=PRIORITY_DOCUMENT)
+        if self.url:
+            if cache_page and not self.parser:
+                self.back_forward_cache.put(
+                    len(self.history) - 1, CachedPage(self))
+                self.animations = {}
+            else:
+                self.js.discard()
         self.scroll = 0
         self.scroll_changed_in_tab = True
+        self.focus = None
         self.task_runner.clear_pending_tasks()
-        headers, body = request(url, self.url, payload=body)
+        self.responses = [response]
         self.url = url
         self.history.append(url)
 
         self.allowed_origins = None
-        if "content-security-policy" in headers:
-           csp = headers["content-security-policy"].split()
+        if "content-security-policy" in response.headers:
+           csp = response.headers["content-security-policy"].split()
            if len(csp) > 0 and csp[0] == "default-src":
                self.allowed_origins = csp[1:]
 
-        self.nodes = HTMLParser(body).parse()
-
+        self.preloads = {}
+        self.style_preloads = []
         self.js = JSContext(self)
+        self.set_rules(list(self.default_style_sheet))
+        # Styles computed while the page loads are its first, so they
+        # must not start transitions.
+        self.suppress_transitions = True
+        self.scanner = PreloadScanner()
+        self.parser = HTMLParser()
+        self.last_partial_render = None
+        self.parse_chunks(iter(response))
+
+    def parse_chunks(self, chunks):
+        for chunk in chunks:
+            for kind, link in self.scanner.feed(chunk):
+                self.preload(kind, resolve_url(link, self.url))
+            self.parser.feed(chunk)
+            if self.needs_partial_render():
+                self.last_partial_render = time.time()
+                # Let the render, and anything else waiting, run before
+                # parsing continues.
+                self.task_runner.schedule_task(Task(self.render_partial))
+                self.task_runner.schedule_task(
+                    Task(self.parse_chunks, chunks))
+                return
+        self.finish_load()
+
+    def finish_load(self):
+        url = self.url
+        self.nodes = self.parser.close()
+        self.parser = None
+        self.scanner = None
+
         scripts = [node.attributes["src"] for node
                    in tree_to_list(self.nodes, [])
                    if isinstance(node, Element)
                    and node.tag == "script"
                    and "src" in node.attributes]
+        script_fetches = []
         for script in scripts:
             script_url = resolve_url(script, url)
             if not self.allowed_request(script_url):
                 print("Blocked script", script, "due to CSP")
                 continue
+            script_fetches.append((script_url,
+                self.fetch_subresource(script_url, PRIORITY_SCRIPT)))
 
-            header, body = request(script_url, url)
-            task = Task(self.js.run, script_url, body)
-            self.task_runner.schedule_task(task)
-
-        self.rules = self.default_style_sheet.copy()
         links = [node.attributes["href"]
                  for node in tree_to_list(self.nodes, [])
                  if isinstance(node, Element)
                  and node.tag == "link"
                  and "href" in node.attributes
                  and node.attributes.get("rel") == "stylesheet"]
+        style_fetches = []
         for link in links:
             style_url = resolve_url(link, url)
             if not self.allowed_request(style_url):
                 print("Blocked style", link, "due to CSP")
                 continue
+            style_fetches.append(
+                self.fetch_subresource(style_url, PRIORITY_STYLE))
+
+        for script_url, script_fetch in script_fetches:
+            response, body = script_fetch.result()
+            self.responses.append(response)
+            task = Task(self.js.run, script_url, body)
+            self.task_runner.schedule_task(task)
+
+        self.set_rules(list(self.default_style_sheet))
+        for style_fetch in style_fetches:
+            try:
+                response, body = style_fetch.result()
+            except:
+                continue
+            self.responses.append(response)
+            self.add_rules(STYLE_SHEET_CACHE.parse(body))
+        self.set_needs_render()
+
+    def set_rules(self, rules):
+        self.rules = rules
+        self.rules_version = next(STYLE_SHEET_VERSIONS)
+
+    def add_rules(self, rules):
+        self.rules.extend(rules)
+        self.rules_version = next(STYLE_SHEET_VERSIONS)
+
+    def compiled_style_sheet(self):
+        if not self.style_sheet or \
+            self.style_sheet.version != self.rules_version:
+            self.style_sheet = CompiledStyleSheet(
+                self.rules, self.rules_version)
+        return self.style_sheet
+
+    def needs_partial_render(self):
+        if not USE_BROWSER_THREAD or not USE_PROGRESSIVE_RENDERING:
+            return False
+        if self.last_partial_render != None and \
+            time.time() - self.last_partial_render < \
+                PROGRESSIVE_RENDER_INTERVAL_SEC:
+            return False
+        # Rendering before the page's stylesheets arrive would flash
+        # unstyled content.
+        if not all([self.preloads[url].done()
+            for url in self.style_preloads]):
+            return False
+        tree = self.parser.partial_tree()
+        return tree is not None and "body" in [child.tag
+            for child in tree.children if isinstance(child, Element)]
+
+    def showing_previous_page(self):
+        # Until the first partial render, self.nodes and self.document
+        # still belong to the page being navigated away from.
+        return self.parser != None and \
+            self.nodes is not self.parser.partial_tree()
+
+    def render_partial(self):
+        if not self.parser: return
+        self.set_rules(list(self.default_style_sheet))
+        for url in self.style_preloads:
             try:
-                header, body = request(style_url, url)
+                response, body = self.preloads[url].result()
             except:
                 continue
-            self.rules.extend(CSSParser(body).parse())
+            self.add_rules(STYLE_SHEET_CACHE.parse(body))
+        self.nodes = self.parser.partial_tree()
+        self.styled_nodes = None
         self.set_needs_render()
+        self.run_animation_frame(self.scroll)
+
+    def preload(self, kind, url):
+        if kind not in PRELOAD_PRIORITIES: return
+        if url in self.preloads: return
+        if not self.allowed_request(url): return
+        self.preloads[url] = NETWORK.submit(
+            url, self.url, priority=PRELOAD_PRIORITIES[kind])
+        if kind == "style":
+            self.style_preloads.append(url)
+
+    def fetch_subresource(self, url, priority):
+        if url in self.preloads:
+            return self.preloads[url]
+        return NETWORK.submit(url, self.url, priority=priority)
+
+    def transfer_size_text(self):
+        encoded = sum([r.encoded_size for r in self.responses])
+        decoded = sum([r.decoded_size for r in self.responses])
+        return "Transferred {} bytes ({} decoded) in {} responses".format(
+            encoded, decoded, len(self.responses))
+
+    def har(self):
+        return {"log": {
+            "version": "1.2",
+            "creator": {"name": "lab13", "version": "13"},
+            "entries": [response.har_entry() for response in self.responses],
+        }}
+
+    def save_har(self, path):
+        with open(path, "w") as f:
+            json.dump(self.har(), f, indent=2)
 
     def set_needs_render(self):
         self.needs_render = True
@@ -1382,8 +3392,16 @@ class Tab:
         self.measure_render.start()
 
         if self.needs_render:
-            style(self.nodes, sorted(self.rules,
-                key=cascade_priority), self)
+            sheet = self.compiled_style_sheet()
+            if USE_INCREMENTAL_STYLE and self.styled_nodes is self.nodes \
+                and self.styled_version == sheet.version:
+                restyle_dirty(self.nodes, sheet, self)
+            else:
+                style(self.nodes, sheet, self)
+                self.styled_nodes = self.nodes
+                self.styled_version = sheet.version
+            if not self.parser:
+                self.suppress_transitions = False
 
             if self.nodes.children[0].tag == "body":
                 body = self.nodes.children[0]
@@ -1415,6 +3433,7 @@ class Tab:
         self.measure_render.stop()
 
     def click(self, x, y):
+        if self.showing_previous_page(): return
         self.render()
         self.focus = None
         y += self.scroll
@@ -1445,6 +3464,7 @@ class Tab:
             elt = elt.parent
 
     def submit_form(self, elt):
+        if self.showing_previous_page(): return
         if self.js.dispatch_event("submit", elt): return
         inputs = [node for node in tree_to_list(elt, [])
                   if isinstance(node, Element)
@@ -1464,6 +3484,7 @@ class Tab:
         self.load(url, body)
 
     def keypress(self, char):
+        if self.showing_previous_page(): return
         if self.focus:
             if self.js.dispatch_event("keydown", self.focus): return
             self.focus.attributes["value"] += char
@@ -1473,7 +3494,29 @@ class Tab:
         if len(self.history) > 1:
             self.history.pop()
             back = self.history.pop()
-            self.load(back)
+            page = self.back_forward_cache.take(len(self.history))
+            if page:
+                self.restore_page(page)
+            else:
+                self.load(back, cache_page=False)
+
+    def restore_page(self, page):
+        self.task_runner.clear_pending_tasks()
+        self.js.discard()
+        page.restore(self)
+        self.parser = None
+        self.suppress_transitions = False
+        self.history.append(self.url)
+        self.focus = None
+        self.scroll_changed_in_tab = True
+        self.scroll_animation = None
+        self.composited_animation_updates.clear()
+        self.js.resume()
+        if self.document:
+            self.needs_paint = True
+            self.browser.set_needs_animation_frame(self)
+        else:
+            self.set_needs_render()
 
 
 WIDTH, HEIGHT = 800, 600
@@ -1574,6 +3617,11 @@ class TaskRunner:
 
     def handle_quit(self):
         print(self.tab.measure_render.text())
+        if SHOW_CACHE_STATS:
+            print(self.tab.transfer_size_text())
+            print(self.tab.back_forward_cache.text())
+        if HAR_FILE:
+            self.tab.save_har(HAR_FILE)
 
 REFRESH_RATE_SEC = 0.016 # 16ms
 
@@ -1975,6 +4023,10 @@ class Browser:
 
     def handle_quit(self):
         print(self.measure_composite_raster_and_draw.text())
+        if SHOW_CACHE_STATS:
+            for stats in [HTTP_CACHE, NETWORK.scheduler, SELECTOR_STATS,
+                STYLE_SHARING_STATS, INLINE_STYLE_CACHE, STYLE_SHEET_CACHE]:
+                print(stats.text())
         self.tabs[self.active_tab].task_runner.set_needs_quit()
         if USE_GPU:
             sdl2.SDL_GL_DeleteContext(self.gl_context)
@@ -1994,12 +4046,23 @@ if __name__ == "__main__":
         default=False, help='Whether to disable use of the GPU')
     parser.add_argument('--show_composited_layer_borders', action="store_true",
         default=False, help='Whether to visually indicate composited layer borders')
+    parser.add_argument('--http_cache_dir', type=str, default=None,
+        help='Directory for the on-disk HTTP cache')
+    parser.add_argument('--show_cache_stats', action="store_true",
+        default=False,
+        help='Print cache, scheduler and transfer statistics on exit')
+    parser.add_argument('--har_file', type=str, default=None,
+        help='File to write a HAR timing log of the page load to on quit')
     args = parser.parse_args()
 
     USE_BROWSER_THREAD = not args.single_threaded
     USE_GPU = not args.disable_gpu
     USE_COMPOSITING = not args.disable_compositing and not args.disable_gpu
     SHOW_COMPOSITED_LAYER_BORDERS = args.show_composited_layer_borders
+    if args.http_cache_dir:
+        HTTP_CACHE = HTTPCache(disk_dir=args.http_cache_dir)
+    HAR_FILE = args.har_file
+    SHOW_CACHE_STATS = args.show_cache_stats
 
     sdl2.SDL_Init(sdl2.SDL_INIT_EVENTS)
     browser = Browser()
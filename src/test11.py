@@ -34,7 +34,18 @@ class socket:
             assert all(int(value) == len(self.body) for name, value in headers
                        if name.lower() == "content-length")
 
+    def sendall(self, text):
+        self.send(text)
+
     def makefile(self, mode, encoding=None, newline=None):
+        if encoding:
+            output = self.take_response()
+            return io.StringIO(output.decode(encoding).replace(newline, "\n"), newline)
+        else:
+            assert mode == "b"
+            return MockSocketFile(self)
+
+    def take_response(self):
         assert self.connected and self.host and self.port
         if self.port == 80 and self.scheme == "http":
             url = self.scheme + "://" + self.host + self.path
@@ -43,15 +54,12 @@ class socket:
         else:
             url = self.scheme + "://" + self.host + ":" + str(self.port) + self.path
         self.Requests.setdefault(url, []).append(self.request)
+        self.request = b""
         assert self.method == self.URLs[url][0], f"Made a {self.method} request to a {self.URLs[url][0]} URL"
         output = self.URLs[url][1]
         if self.URLs[url][2]:
             assert self.body == self.URLs[url][2], (self.body, self.URLs[url][2])
-        if encoding:
-            return io.StringIO(output.decode(encoding).replace(newline, "\n"), newline)
-        else:
-            assert mode == "b"
-            return io.BytesIO(output)
+        return output
 
     def close(self):
         self.connected = False
@@ -81,6 +89,34 @@ class socket:
     def clear_history(cls):
         cls.Requests = {}
 
+class MockSocketFile:
+    """A binary socket file that answers each request sent on its socket,
+    so one file can be reused for a whole keep-alive connection."""
+
+    def __init__(self, socket):
+        self.socket = socket
+        self.buffer = io.BytesIO()
+
+    def fill(self):
+        if self.socket.request:
+            rest = self.buffer.read()
+            self.buffer = io.BytesIO(rest + self.socket.take_response())
+
+    def readline(self, *args):
+        self.fill()
+        return self.buffer.readline(*args)
+
+    def read(self, *args):
+        self.fill()
+        return self.buffer.read(*args)
+
+    def read1(self, *args):
+        self.fill()
+        return self.buffer.read1(*args)
+
+    def close(self):
+        pass
+
 class ssl:
     def wrap_socket(self, s, server_hostname):
         assert s.host == server_hostname